@@ -1,27 +1,281 @@
-from itertools import cycle
+"""Redbike benchmarks.
+
+Starts a throwaway redis-server on a free port and times Redbike's hot
+paths at each size, printing the results as JSON.
+
+Usage:
+ benchmark.py [--sizes=<SIZES>] [--workers=<N>] [--queues=<N>]
+              [--redis-server=<PATH>] [--output=<FILE>]
+
+Options:
+ --sizes=<SIZES>        Comma separated job counts. [default: 10000,100000]
+ --workers=<N>          Worker processes for the multi-worker run.
+                        [default: 4]
+ --queues=<N>           Work queues to spread jobs over. [default: 2]
+ --redis-server=<PATH>  The redis-server to run. [default: redis-server]
+ --output=<FILE>        Write JSON here instead of stdout.
+"""
+
+from datetime import datetime, timedelta
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import socket
+import subprocess
 import sys
+import tempfile
+import time
+
+import docopt
+
+from redbike import Redbike, RoundRobin, __version__
+
 
-from redbike import Redbike, RoundRobin
+PREFIX = 'redbike-benchmark'
 
 
 class Worker(RoundRobin):
+    """Spreads jobs over `initstring` queues and does nothing with them."""
 
-    def queue_names(self, bike):
-        return ['%s-work-%s' % (bike.prefix, x)
-                for x in xrange(int(self.initstring))]
+    def queue_names(self):
+        return [self.name_queue(x) for x in range(int(self.initstring))]
 
-    def work(self, bike, jobid):
-        bike.log.debug(jobid)
+    def work(self, jobid):
+        pass
 
 
-if __name__ == '__main__':
+class RedisServer(object):
+    """A redis-server on a free port, in a temporary directory."""
+
+    def __init__(self, executable='redis-server'):
+        self.executable = executable
+        self.port = free_port()
+        self.dir = tempfile.mkdtemp(prefix='redbike-benchmark-')
+        self.process = None
+
+    def __enter__(self):
+        self.process = subprocess.Popen(
+            [self.executable, '--port', str(self.port), '--save', '',
+             '--appendonly', 'no', '--dir', self.dir],
+            stdout=open(os.devnull, 'w'))
+        deadline = time.time() + 10
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', self.port)).close()
+                return self
+            except socket.error:
+                if time.time() > deadline or self.process.poll() is not None:
+                    self.__exit__()
+                    raise RuntimeError("redis-server didn't start")
+                time.sleep(.05)
+
+    def __exit__(self, *exc_info):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def result(name, jobs, seconds, latencies):
+    """Throughput, and p50/p99 of per-call latency in milliseconds."""
+    latencies = sorted(latencies)
+
+    def percentile(q):
+        if not latencies:
+            return None
+        index = min(len(latencies) - 1, int(q / 100.0 * len(latencies)))
+        return round(latencies[index] * 1000, 3)
+
+    return {"benchmark": name,
+            "jobs": jobs,
+            "seconds": round(seconds, 3),
+            "jobs_per_second": round(jobs / seconds, 1) if seconds else None,
+            "calls": len(latencies),
+            "p50_ms": percentile(50),
+            "p99_ms": percentile(99)}
+
+
+def timed(call, *args, **kwargs):
+    started = time.time()
+    value = call(*args, **kwargs)
+    return value, time.time() - started
+
+
+def rrule():
+    return "DTSTART:%s\nRRULE:FREQ=SECONDLY" % (
+        (datetime.utcnow() - timedelta(minutes=1)).strftime('%Y%m%dT%H%M%S'))
+
+
+def make_bike(port, queues):
+    return Redbike(Worker(queues), prefix=PREFIX,
+                   redis_config={'port': port}, block_timeout=0,
+                   timefile=os.devnull)
+
+
+def jobids(size, queues, kind='job'):
+    return ('%s:%s:%s' % (kind, i, i % queues) for i in range(size))
 
-    JOBS = int(sys.argv[1])
-    QUEUES = sys.argv[2]
-    bike = Redbike(Worker(QUEUES), prefix='redbike-benchmark')
-    bike.flush()
-    queues = cycle(xrange(int(QUEUES)))
-    for i in range(int(JOBS)):
-        # bike.set('A:%s:%s' % (i, queues.next()),
-        #          'DTSTART:20131009T164510\nRRULE:FREQ=MINUTELY')
-        bike.set('B:%s:%s' % (i, queues.next()), 'CONTINUE')
+
+def bench_set(bike, size, queues, chunk_size=1000):
+    """Bulk set: set_many() of due one-off jobs, timed per chunk."""
+    latencies = []
+    started = time.time()
+    last = [started]
+
+    def progress(count, bad):
+        now = time.time()
+        latencies.append(now - last[0])
+        last[0] = now
+
+    due = 'AT:%s' % int(time.time() - 1)
+    bike.set_many(((jobid, due) for jobid in jobids(size, queues)),
+                  chunk_size=chunk_size, progress=progress)
+    return result('set', size, time.time() - started, latencies)
+
+
+def bench_dispatch(bike, size):
+    """Dispatch the due backlog left by bench_set, timed per call."""
+    latencies = []
+    moved = 0
+    started = time.time()
+    while moved < size:
+        count, latency = timed(bike.dispatch_due, time.time())
+        if not count:
+            break
+        moved += count
+        latencies.append(latency)
+    return result('dispatch', moved, time.time() - started, latencies)
+
+
+def consume(bike, limit=None):
+    """Work queued jobs until the queues are empty. Returns latencies."""
+    latencies = []
+    worked = 0
+    for claimed in bike.consumer_generator():
+        if claimed:
+            _, latency = timed(bike.work_batch, claimed)
+            latencies.append(latency)
+            worked += len(claimed)
+        elif not any(bike.stats()['queues'].values()):
+            break
+        if limit is not None and worked >= limit:
+            break
+    return latencies
+
+
+def bench_consume(bike, size, batch_size=1):
+    """One worker drains the dispatched jobs, timed per work_batch()."""
+    bike.batch_size = batch_size
+    latencies, seconds = timed(consume, bike)
+    return result('consume_batch_%s' % batch_size, size, seconds,
+                  latencies)
+
+
+def _consume_process(port, queues, results):
+    results.put(consume(make_bike(port, queues)))
+
+
+def bench_consume_multi(bike, size, port, queues, workers):
+    """`workers` processes drain the queues together."""
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=_consume_process,
+                                         args=(port, queues, results))
+                 for _ in range(workers)]
+    started = time.time()
+    for process in processes:
+        process.start()
+    latencies = []
+    for _ in processes:
+        latencies.extend(results.get())
+    seconds = time.time() - started
+    for process in processes:
+        process.join()
+    return result('consume_%s_workers' % workers, size, seconds, latencies)
+
+
+def bench_reschedule(bike, size, queues):
+    """Work RRULE jobs, so each is rescheduled from its upcoming runs."""
+    bike.set_many(((jobid, rrule()) for jobid
+                   in jobids(size, queues, kind='rrule')))
+    while bike.dispatch_due(time.time() + 3600):
+        pass
+    bike.batch_size = 10
+    latencies, seconds = timed(consume, bike)
+    return result('reschedule_rrule', size, seconds, latencies)
+
+
+def bench_statuses(bike, size):
+    """Stream every status with get_statuses(), timed per page."""
+    latencies = []
+    count = 0
+    started = last = time.time()
+    for _ in bike.get_statuses(before=time.time() + 1):
+        count += 1
+        if count % bike.scan_count == 0:
+            now = time.time()
+            latencies.append(now - last)
+            last = now
+    return result('get_statuses', count, time.time() - started, latencies)
+
+
+def run(port, sizes, queues, workers):
+    results = []
+    for size in sizes:
+        bike = make_bike(port, queues)
+        bike.flush()
+        results.append(bench_set(bike, size, queues))
+        results.append(bench_dispatch(bike, size))
+        results.append(bench_consume(bike, size))
+        bike.flush()
+        bike.set_many((jobid, 'NOW') for jobid in jobids(size, queues))
+        results.append(bench_consume(bike, size, batch_size=10))
+        bike.flush()
+        bike.set_many((jobid, 'NOW') for jobid in jobids(size, queues))
+        results.append(bench_consume_multi(bike, size, port, queues,
+                                           workers))
+        results.append(bench_statuses(bike, size))
+        bike.flush()
+        results.append(bench_reschedule(bike, size, queues))
+        bike.flush()
+        for benchmark in results[-7:]:
+            sys.stderr.write("%(benchmark)20s %(jobs)9s jobs "
+                             "%(jobs_per_second)10s jobs/s "
+                             "p50 %(p50_ms)s ms p99 %(p99_ms)s ms\n"
+                             % benchmark)
+    return results
+
+
+def main():
+    args = docopt.docopt(__doc__)
+    sizes = [int(size) for size in args['--sizes'].split(',')]
+    queues = int(args['--queues'])
+    workers = int(args['--workers'])
+    with RedisServer(args['--redis-server']) as server:
+        redis_version = make_bike(server.port, queues).redis.info()[
+            'redis_version']
+        report = {"redbike": __version__.strip(),
+                  "python": platform.python_version(),
+                  "redis": redis_version,
+                  "queues": queues,
+                  "workers": workers,
+                  "results": run(server.port, sizes, queues, workers)}
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args['--output']:
+        with open(args['--output'], 'w') as outfile:
+            outfile.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,9 @@ import logging
 import pkg_resources
 import sys
 
+from redbike.metrics import Metrics
+from redbike.observers import Observer
+from redbike.rrules import RRuleCache
 from redbike.schedule import Redbike, RoundRobin, StopWork, UnsetJob
 
 
@@ -19,5 +22,5 @@ hdlr.setFormatter(logging.Formatter(FORMAT))
 log.addHandler(hdlr)
 
 
-__all__ = ['log', 'Redbike', 'RoundRobin', 'StopWork', 'UnsetJob',
-           '__version__']
+__all__ = ['log', 'Metrics', 'Observer', 'Redbike', 'RoundRobin',
+           'RRuleCache', 'StopWork', 'UnsetJob', '__version__']
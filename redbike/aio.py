@@ -0,0 +1,404 @@
+"""An asyncio flavour of Redbike, for workers whose jobs wait on I/O.
+
+Needs Python 3.6+ and redis-py 4.2+ (for redis.asyncio). AsyncRedbike
+uses the same keys and Lua scripts as Redbike, so async and sync
+workers can share queues and a timeline. It sets, unsets and works
+jobs; run the dispatcher and the other commands with Redbike. Redbike
+methods it has no coroutine version of raise NotImplementedError.
+"""
+
+import asyncio
+import threading
+import time
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # pragma: no cover
+    aioredis = None
+
+from redbike.schedule import (Redbike, SIGNALS, StopWork, UnsetJob, _e,
+                              _jobtag, _ms, _Unpipelined)
+
+
+def _use_redbike(self, *args, **kwargs):
+    raise NotImplementedError("AsyncRedbike can't do this; use Redbike.")
+
+
+class AsyncRedbike(Redbike):
+    """Redbike with coroutine versions of the methods it supports.
+
+    The worker's work() must be a coroutine function. Up to
+    `concurrency` jobs are worked at once.
+    """
+
+    _control_task = None
+
+    def connect(self, redis_config):
+        if aioredis is None:
+            raise ImportError("AsyncRedbike needs redis-py 4.2 or later.")
+        if self.cluster:
+            return aioredis.RedisCluster(**redis_config)
+        return aioredis.StrictRedis(**redis_config)
+
+    def pipeline(self):
+        if self.cluster:
+            return _AsyncUnpipelined(self.redis)
+        return self.redis.pipeline(transaction=False)
+
+    async def control(self, signal, queue_name=None):
+        signal = SIGNALS[signal.upper()]
+        if signal == "HALT":
+            await self.redis.set(self.control_key, signal)
+            message = signal
+        elif queue_name is None:
+            raise ValueError("%s needs a queue name" % signal)
+        else:
+            if signal == "PAUSE":
+                await self.redis.sadd(self.paused_key, queue_name)
+            else:
+                await self.redis.srem(self.paused_key, queue_name)
+            message = "%s:%s" % (signal, queue_name)
+        await self.redis.publish(self.control_key, message)
+
+    async def is_halted(self):
+        if self.stop_event is not None and self.stop_event.is_set():
+            return True
+        if self._control_task is not None:
+            if not self._control_task.done():
+                return False  # the listener sets stop_event on HALT
+            self.log.warning("control listener died, checking the key")
+            self._control_task = None
+        return await self.sync_control()
+
+    async def clear_control(self):
+        await self.redis.delete(self.control_key)
+        await self.redis.publish(self.control_key, "CLEAR")
+        self._set_halted(False)
+
+    async def listen_for_control(self):
+        """Follow control signals from a background task.
+
+        Like Redbike.listen_for_control(), but in the event loop.
+        Returns once subscribed. The cluster client has no pubsub, so
+        in cluster mode the control key is checked instead.
+        """
+        if self._control_task is not None or self.cluster:
+            return
+        if self.stop_event is None:
+            self.stop_event = threading.Event()
+        subscribed = asyncio.Event()
+        self._control_task = asyncio.ensure_future(
+            self._follow_control(subscribed))
+        try:
+            await asyncio.wait_for(subscribed.wait(), 10)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _follow_control(self, subscribed):
+        wait = 1
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                await pubsub.subscribe(self.control_key)
+                # Catch up on anything sent before we subscribed.
+                self._set_halted(await self.sync_control())
+                subscribed.set()
+                wait = 1
+                async for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        self.apply_control(_e(message['data']))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.log.exception("control channel failed")
+            # Back off while Redis is down, up to half a minute.
+            self.log.warning("control channel lost, resubscribing in %ss",
+                             wait)
+            await asyncio.sleep(wait)
+            wait = min(wait * 2, 30)
+
+    async def sync_control(self):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.get(self.control_key)
+        pipe.smembers(self.paused_key)
+        control, paused = await pipe.execute()
+        self.paused = set(map(_e, paused))
+        return _e(control) == "HALT"
+
+    async def set_status(self, jobid, event, timestamp=None, client=None):
+        if timestamp is None:
+            timestamp = time.time()
+        await self.set_status_script(keys=self.keys_for(jobid),
+                                     args=[jobid, event, _ms(timestamp)],
+                                     client=client)
+
+    async def set_schedule(self, jobid, schedule, client=None):
+        client = client or self.redis
+        await client.hset(self.keys_for(jobid).schedules_key, jobid,
+                          schedule)
+        await client.delete(self.upcoming_key(jobid))
+
+    async def set_upcoming(self, jobid, runs, client=None):
+        client = client or self.redis
+        await client.delete(self.upcoming_key(jobid))
+        if runs:
+            await client.rpush(self.upcoming_key(jobid), *runs)
+
+    async def set(self, jobid, schedule, after=None):
+        await self.set_schedule(jobid, schedule)
+        await self.schedule(jobid, schedule, after=after)
+
+    async def unset(self, jobid, client=None):
+        client = client or self.redis
+        keys = self.keys_for(jobid)
+        await self.unset_status_script(keys=keys, args=[jobid], client=client)
+        await client.hdel(keys.schedules_key, jobid)
+        await client.zrem(keys.timeline_key, jobid)
+        await client.zrem(self.held_key(self.queue_for(jobid)), jobid)
+        await client.delete(self.upcoming_key(jobid))
+        await client.lrem(self.queue_for(jobid), 0, jobid)
+
+    async def add_to_timeline(self, jobid, timestamp, client=None):
+        await self.timeline_script(
+            keys=list(self.keys_for(jobid)) + [self.queue_for(jobid)],
+            args=[jobid, _ms(timestamp), _ms(time.time())], client=client)
+
+    async def enqueue(self, jobid, client=None):
+        await self.enqueue_script(
+            keys=list(self.keys_for(jobid)) + [self.queue_for(jobid)],
+            args=[jobid, _ms(time.time())], client=client)
+
+    async def schedule(self, jobid, schedule, after=None, backoff=None,
+                       client=None):
+        jobid = _e(jobid)
+        schedule = _e(schedule)
+        if schedule is None:
+            await self.unset(jobid, client=client)
+        elif schedule == 'STOP':
+            await self.set_status(jobid, 'STP', client=client)
+        elif schedule == 'CONTINUE' and backoff:
+            await self.add_to_timeline(jobid, time.time() + float(backoff),
+                                       client=client)
+        elif schedule == 'CONTINUE':
+            await self.enqueue(jobid, client=client)
+        elif schedule == 'NOW':
+            await self.set_schedule(jobid, 'STOP', client=client)
+            await self.enqueue(jobid, client=client)
+        elif schedule.startswith("AT:"):
+            await self.set_schedule(jobid, 'STOP', client=client)
+            try:
+                at = float(schedule.split(":")[1])
+            except ValueError:
+                await self.set_status(jobid, 'BAD', client=client)
+                self.log.warning("%s Bad AT: time", jobid)
+                return
+            await self.add_to_timeline(jobid, at, client=client)
+        else:
+            try:
+                runs = self.next_runs(schedule, after=after, jobid=jobid)
+            except ValueError:
+                await self.set_status(jobid, 'BAD', client=client)
+                self.log.warning("%s Bad RRULE", jobid)
+                return
+            if runs:
+                await self.add_to_timeline(jobid, runs[0], client=client)
+                await self.set_upcoming(jobid, runs[1:], client=client)
+            else:
+                await self.set_status(jobid, 'STP', client=client)
+
+    async def reschedule(self, jobid, jobtag, backoff=None, client=None):
+        keys = list(self.keys_for(jobid)) + [
+            self.is_working_key(jobid), self.queue_for(jobid),
+            self.upcoming_key(jobid)]
+        args = [jobtag, jobid, _ms(time.time()), backoff or '']
+        result = await self.reschedule_script(keys=keys, args=args,
+                                              client=client)
+        if client is None and result is not None:
+            await self.schedule(jobid, result)
+        return result
+
+    async def recycle(self, jobid, jobtag, client=None):
+        return await self.recycle_script(
+            keys=list(self.keys_for(jobid)) + [self.is_working_key(jobid)],
+            args=[jobtag], client=client)
+
+    async def is_working(self, jobid):
+        return await self.redis.exists(self.is_working_key(jobid))
+
+    async def consumer_generator(self):
+        while True:
+            claimed = False
+            paused = self.paused_queues()
+            for shard, queue_name in self.shard_queues():
+                if queue_name in paused:
+                    continue
+                pairs = await self.consume(shard, queue_name)
+                claimed = claimed or bool(pairs)
+                yield pairs
+            if not claimed and self.block_timeout > 0:
+                yield await self.block_for_work()
+
+    async def consume(self, shard, queue_name):
+        jobtags = [_jobtag() for _ in range(self.batch_size)]
+        keys = list(self.shard_keys(shard)) + [queue_name]
+        args = self.consume_args(queue_name) + jobtags
+        jobids, statuses = await self.consume_script(keys=keys, args=args)
+        jobids = [_e(jobid) for jobid in jobids]
+        self.record_claimed(statuses)
+        pairs = list(zip(jobids, jobtags))
+        if pairs and self.observers:
+            self.notify('on_claim', pairs)
+        return pairs
+
+    async def block_for_work(self):
+        shards = self.blocking_shards()
+        if not shards:
+            await asyncio.sleep(self.block_timeout)
+            return []
+        ready_keys = {self.ready_key(queue_name): queue_name
+                      for queue_name in shards}
+        popped = await self.redis.brpop(list(ready_keys), self.block_timeout)
+        if popped is None:
+            return []
+        queue_name = ready_keys[_e(popped[0])]
+        return await self.consume(shards[queue_name], queue_name)
+
+    async def work(self, concurrency=None):
+        """Run up to `concurrency` worker loops until halted."""
+        concurrency = int(concurrency or self.concurrency)
+        if self.listen:
+            await self.listen_for_control()
+        await asyncio.gather(*[self.work_loop(self.consumer_generator())
+                               for _ in range(concurrency)])
+
+    async def work_loop(self, consumer):
+        async for claimed in consumer:
+            if claimed:
+                await self.work_batch(claimed)
+            self.metrics.maybe_export()
+            if await self.is_halted():
+                self.log.info("stopping on command")
+                break
+
+    async def work_batch(self, claimed):
+        worked = [(jobid, jobtag) + await self._work_one(jobid)
+                  for jobid, jobtag in claimed]
+        pipe = self.pipeline()
+        finished = []
+        try:
+            for jobid, jobtag, outcome, backoff in worked:
+                if await self._wrap_up(jobid, jobtag, outcome, backoff,
+                                       pipe):
+                    finished.append((len(pipe) - 1, jobid))
+            results = await pipe.execute()
+        except Exception as ex:
+            self.log.exception(ex)
+            for jobid, jobtag in claimed:
+                if await self.recycle(jobid, jobtag):
+                    await self.set_status(jobid, 'DIE')
+            return
+        await self._refill(finished, results, pipe)
+
+    async def _refill(self, finished, results, pipe):
+        refills = []
+        try:
+            for position, jobid in finished:
+                if self.observers:
+                    self.notify('on_reschedule', jobid, results[position])
+                if results[position] is not None:
+                    refills.append(jobid)
+                    await self.schedule(jobid, results[position],
+                                        client=pipe)
+            if len(pipe):
+                await pipe.execute()
+        except Exception as ex:
+            self.log.exception(ex)
+            for jobid in refills:
+                await self.set_status(jobid, 'DIE')
+
+    async def _work_one(self, jobid):
+        backoff = None
+        if self.observers:
+            self.notify('on_work_start', jobid)
+        started = time.time()
+        try:
+            backoff = await self.worker.work(jobid)
+            outcome = 'completed'
+        except StopWork:
+            outcome = 'stopped'
+        except UnsetJob:
+            outcome = 'unset'
+        except Exception as ex:
+            self.log.exception(ex)
+            outcome = 'died'
+        duration = time.time() - started
+        self.metrics.incr(outcome)
+        self.metrics.observe('work_duration', duration)
+        if self.observers:
+            self.notify('on_work_end', jobid, duration, outcome)
+        return outcome, backoff
+
+    async def _wrap_up(self, jobid, jobtag, outcome, backoff, client):
+        if outcome == 'stopped':
+            await self.set_schedule(jobid, 'STOP', client=client)
+        elif outcome == 'unset':
+            await self.unset(jobid, client=client)
+        elif outcome == 'died':
+            await self.set_status(jobid, 'DIE', client=client)
+        if outcome in ('unset', 'died'):
+            await self.recycle(jobid, jobtag, client=client)
+            return False
+        await self.reschedule(jobid, jobtag, backoff=backoff, client=client)
+        return True
+
+    async def tell(self, jobid):
+        keys = self.keys_for(jobid)
+        next_run = await self.redis.zscore(keys.timeline_key, jobid)
+        if next_run is None:
+            next_run = await self.redis.zscore(
+                self.held_key(self.queue_for(jobid)), jobid)
+        return {"status": _e(await self.redis.hget(keys.statuses_key,
+                                                   jobid)),
+                "schedule": _e(await self.redis.hget(keys.schedules_key,
+                                                     jobid)),
+                "next_run": next_run,
+                "upcoming": [_ms(run) for run in await self.redis.lrange(
+                    self.upcoming_key(jobid), 0, -1)],
+                "working": await self.is_working(jobid)}
+
+    async def close(self):
+        if self._control_task is not None:
+            self._control_task.cancel()
+            try:
+                await self._control_task
+            except asyncio.CancelledError:
+                pass
+            self._control_task = None
+        await self.redis.close()
+
+    # Redbike methods with no coroutine version here. Run against the
+    # async client they'd only make coroutines nobody awaits, and do
+    # nothing, so they raise instead.
+    dispatch = dispatch_due = dispatch_page = drain = _use_redbike
+    sleep_until_due = wait_for_wakeup = _use_redbike
+    release_prefetched = release = point_in_time = _use_redbike
+    set_many = load_csv = flush = unlink = stats = _use_redbike
+    get_statuses = get_schedules = reindex_statuses = _use_redbike
+    remove_from_queue = work_threads = work_processes = _use_redbike
+
+
+class _AsyncUnpipelined(_Unpipelined):
+
+    def __getattr__(self, name):
+        command = getattr(self.client, name)
+        if name == 'script_load':
+            return command
+
+        async def run(*args, **kwargs):
+            result = await command(*args, **kwargs)
+            self.results.append(result)
+            return result
+        return run
+
+    async def execute(self):
+        return _Unpipelined.execute(self)
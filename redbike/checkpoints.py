@@ -0,0 +1,44 @@
+import os
+
+
+class FileCheckpoint(object):
+    """Keeps the dispatcher's point in time in a file.
+
+    Each write goes to a temporary file which is renamed over the old
+    one, so readers never see a partial write.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def read(self):
+        """The last point in time written, or None if there isn't one."""
+        if os.path.exists(self.path):
+            with open(self.path) as timefile:
+                return float(timefile.read())
+
+    def write(self, point_in_time):
+        path_tmp = '%s.%s' % (self.path, os.getpid())
+        with open(path_tmp, 'w') as timefile:
+            timefile.write('%.3f' % point_in_time)
+        os.rename(path_tmp, self.path)
+
+
+class RedisCheckpoint(object):
+    """Keeps the dispatcher's point in time in a Redis key.
+
+    A dispatcher started on another host picks up where the last one
+    left off, and there's no file to write.
+    """
+
+    def __init__(self, redis, key):
+        self.redis = redis
+        self.key = key
+
+    def read(self):
+        point_in_time = self.redis.get(self.key)
+        if point_in_time is not None:
+            return float(point_in_time)
+
+    def write(self, point_in_time):
+        self.redis.set(self.key, '%.3f' % point_in_time)
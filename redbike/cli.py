@@ -3,25 +3,40 @@
 Usage:
  redbike [--config=<CONF>] set <JOBID> <SCHEDULE> [--after=<TIMESTAMP>]
  redbike [--config=<CONF>] unset <JOBID>
- redbike [--config=<CONF>] dispatch [<WORKER>]
+ redbike [--config=<CONF>] load [<SCHEDULESCSV>] [--after=<TIMESTAMP>]
+         [--chunk-size=<N>]
+ redbike [--config=<CONF>] dispatch [<WORKER>] [--shard=<SHARD>]
          [--schedules=<SCHEDULESCSV> [--after=<TIMESTAMP>]]
- redbike [--config=<CONF>] work [<WORKER>]
- redbike [--config=<CONF>] statuses [--before=<TIMESTAMP>]
+ redbike [--config=<CONF>] work [<WORKER>] [--concurrency=<N>]
+         [--executor=<EXECUTOR>]
+ redbike [--config=<CONF>] statuses [--before=<TIMESTAMP>] [--event=<EVENT>]
+ redbike [--config=<CONF>] reindex
  redbike [--config=<CONF>] schedules
  redbike [--config=<CONF>] tell <JOBID>
- redbike [--config=<CONF>] control <SIGNAL>
+ redbike [--config=<CONF>] control <SIGNAL> [<QUEUE>]
+ redbike [--config=<CONF>] flush [--dry-run]
+ redbike [--config=<CONF>] stats
 
 Arguments:
  <JOBID>        The id string of a job.
  <SCHEDULE>     The schedule for a job.
                 Either RRule, CONTINUE, AT:<TIMESTAMP> for a one-off or STOP.
  <WORKER>       Worker instance. Overrides config. package.modeule:Worker('X')
- <SIGNAL>       Signal to dispatcher and worker processes. Currently only HALT.
+ <SCHEDULESCSV> CSV of JOBID, SCHEDULE pairs. Reads stdin if missing or -.
+ <SIGNAL>       Signal to dispatcher and worker processes. HALT, or PAUSE or
+                RESUME with a QUEUE.
+ <QUEUE>        A queue as the worker names it, e.g. work-A.
 
 Options:
- -a, --after=<TIMESTAMP>         Unix time.
+ -a, --after=<TIMESTAMP>         Unix time. Defaults to the checkpoint.
  -b, --before=<TIMESTAMP>        Unix time.
+ -e, --event=<EVENT>             Only jobs whose last status was EVENT.
  -s, --schedules=<SCHEDULESCSV>  CSV of JOBID, SCHEDULE pairs for startup.
+ -d, --shard=<SHARD>             Dispatch only timeline shard I of N, as I/N.
+ -n, --chunk-size=<N>            Jobs set per round trip. [default: 1000]
+ -j, --concurrency=<N>           Jobs to work at once. Overrides config.
+ -x, --executor=<EXECUTOR>       thread or process. Overrides config.
+ --dry-run                       Count the keys flush would delete.
  -c, --config=<CONF>             A config file with a [redbike] section.
 """
 
@@ -38,14 +53,22 @@ import threading
 import docopt
 import resolver
 
-from redbike import log, Redbike, __version__
+from redbike import log, Metrics, Redbike, __version__
+from redbike.observers import SlowJobLogger
 
 
 # TODO: Validate all the inputs!
 
 
-def do_set(bike, args):
+def after_or_checkpoint(bike, args):
     after = args['--after']
+    if after is None:
+        return bike.point_in_time()
+    return float(after)
+
+
+def do_set(bike, args):
+    after = after_or_checkpoint(bike, args)
     jobid = args['<JOBID>']
     schedule = args['<SCHEDULE>']
     bike.set(jobid, schedule, after=after)
@@ -56,25 +79,52 @@ def do_unset(bike, args):
     bike.unset(jobid)
 
 
+def do_load(bike, args):
+    after = after_or_checkpoint(bike, args)
+    csvfilename = args['<SCHEDULESCSV>'] or '-'
+    csvfile = sys.stdin if csvfilename == '-' else csvfilename
+
+    def progress(count, bad):
+        log.info("loaded %s rows, %s bad", count, bad)
+
+    count, bad = bike.load_csv(csvfile, after=after,
+                               chunk_size=int(args['--chunk-size']),
+                               progress=progress)
+    log.info("done: %s rows, %s bad", count, bad)
+
+
 def do_dispatch(bike, args):
     after = args['--after']
     csvfilename = args['--schedules']
+    shard = args['--shard']
+    if shard is not None:
+        shard, shards = map(int, shard.split('/'))
+        if shards != bike.shards or not 0 <= shard < shards:
+            sys.exit("--shard must be I/%s with 0 <= I < %s"
+                     % (bike.shards, bike.shards))
     bike.clear_control()
-    bike.dispatch(after=after, csvfilename=csvfilename)
+    bike.dispatch(after=after, csvfilename=csvfilename, shard=shard)
 
 
 def do_work(bike, args):
     bike.clear_control()
-    bike.work()
+    bike.work(concurrency=args['--concurrency'],
+              executor=args['--executor'])
 
 
 def do_statuses(bike, args):
     before = args['--before']
+    event = args['--event']
     writer = csv.writer(sys.stdout)
-    for jobid, event, timestamp in bike.get_statuses(before=before):
+    for jobid, event, timestamp in bike.get_statuses(before=before,
+                                                     event=event):
         writer.writerow([jobid, event, timestamp])
 
 
+def do_reindex(bike, args):
+    print bike.reindex_statuses()
+
+
 def do_schedules(bike, args):
     writer = csv.writer(sys.stdout)
     for jobid, schedule in bike.get_schedules():
@@ -87,7 +137,21 @@ def do_tell(bike, args):
 
 
 def do_control(bike, args):
-    bike.control(args['<SIGNAL>'])
+    bike.control(args['<SIGNAL>'], queue_name=args['<QUEUE>'])
+
+
+def do_flush(bike, args):
+    dry_run = args['--dry-run']
+
+    def progress(count):
+        log.info("%s %s keys", "found" if dry_run else "flushed", count)
+
+    count = bike.flush(dry_run=dry_run, progress=progress)
+    print count
+
+
+def do_stats(bike, args):
+    print json.dumps(bike.stats(), indent=2, sort_keys=True)
 
 
 _shutdown = False
@@ -110,13 +174,42 @@ def run():
         redis_conf = {}
     command = [k for k, v in args.items() if v and k[0].isalpha()][0]
     stop_event = threading.Event()
+    exporter = conf.get('metrics-exporter')
+    if exporter:
+        exporter = resolver.resolve(exporter)
+    metrics = Metrics(exporter=exporter,
+                      interval=conf.get('metrics-interval', 60))
+    observers = []
+    if conf.get('slow-job-threshold'):
+        observers.append(SlowJobLogger(conf['slow-job-threshold'], log=log))
     bike = Redbike(resolver.resolve(args['<WORKER>'] or conf['worker']),
                    prefix=conf.get('prefix'),
                    redis_config=redis_conf,
                    log=log,
                    timefile=conf.get('timefile'),
+                   checkpoint=conf.get('checkpoint', 'file'),
+                   checkpoint_interval=conf.get('checkpoint-interval', 1),
                    stop_event=stop_event,
-                   default_timeout=conf.get('default-timeout', 10))
+                   default_timeout=conf.get('default-timeout', 10),
+                   default_high_water=conf.get('high-water'),
+                   default_spread=conf.get('spread'),
+                   spread_mode=conf.get('spread-mode', 'hash'),
+                   listen=conf.get('control-listener', True),
+                   dispatch_limit=conf.get('dispatch-limit', 1000),
+                   max_sleep=conf.get('max-sleep', 1),
+                   prefetch=conf.get('prefetch', 0),
+                   block_timeout=conf.get('block-timeout', 1),
+                   batch_size=conf.get('batch-size', 1),
+                   rrule_cache_size=conf.get('rrule-cache-size', 1024),
+                   lookahead=conf.get('lookahead', 10),
+                   scan_count=conf.get('scan-count', 1000),
+                   index_events=conf.get('index-events', True),
+                   concurrency=conf.get('concurrency', 1),
+                   executor=conf.get('executor', 'thread'),
+                   shards=conf.get('shards', 1),
+                   cluster=conf.get('cluster', False),
+                   metrics=metrics,
+                   observers=observers)
     func = globals()['do_' + command]
     pipe_r, pipe_w = os.pipe()
     flags = fcntl.fcntl(pipe_w, fcntl.F_GETFL, 0)
@@ -0,0 +1,107 @@
+from bisect import bisect_left
+import json
+import logging
+import threading
+import time
+
+
+# Upper bounds, in seconds, of the default histogram buckets.
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5,
+                   5, 10, 30, 60, 300, 900, 3600)
+
+
+class Histogram(object):
+    """Counts of observed values in fixed buckets, plus their sum.
+
+    Values above the last bucket are counted in an overflow bucket.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, q):
+        """The upper bound of the bucket holding the q-th percentile.
+
+        None if nothing was observed, inf if it's in the overflow bucket.
+        """
+        if not self.count:
+            return None
+        rank = q / 100.0 * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+
+    def snapshot(self):
+        return {"count": self.count,
+                "sum": self.sum,
+                "buckets": list(zip(self.buckets + (float('inf'),),
+                                    self.counts)),
+                "p50": self.percentile(50),
+                "p99": self.percentile(99)}
+
+
+class Metrics(object):
+    """In-process counters and histograms.
+
+    Redbike counts jobs dispatched, consumed, completed, stopped and
+    died, and times dispatch lag, queue wait and work duration. If an
+    exporter is given, export() passes it a snapshot, which Redbike
+    does from its dispatch and work loops every `interval` seconds.
+    """
+
+    def __init__(self, exporter=None, interval=60):
+        self.exporter = exporter
+        self.interval = float(interval)
+        self.counters = {}
+        self.histograms = {}
+        self.exported_at = time.time()
+        self._lock = threading.Lock()
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, value):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def snapshot(self):
+        with self._lock:
+            return {"counters": dict(self.counters),
+                    "histograms": {name: histogram.snapshot() for
+                                   name, histogram
+                                   in self.histograms.items()}}
+
+    def export(self):
+        self.exported_at = time.time()
+        if self.exporter is not None:
+            self.exporter(self.snapshot())
+
+    def maybe_export(self):
+        """Export if there's an exporter and `interval` has passed."""
+        if (self.exporter is not None and
+                time.time() - self.exported_at >= self.interval):
+            self.export()
+
+
+class LogExporter(object):
+    """Logs each snapshot as JSON."""
+
+    def __init__(self, log=None):
+        self.log = log or logging.getLogger('redbike-metrics')
+
+    def __call__(self, snapshot):
+        self.log.info("metrics %s", json.dumps(snapshot, sort_keys=True))
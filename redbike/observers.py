@@ -0,0 +1,87 @@
+import cProfile
+import logging
+import pstats
+import random
+import threading
+
+try:
+    from StringIO import StringIO
+except ImportError:  # py3
+    from io import StringIO
+
+
+class Observer(object):
+    """Hooks called by Redbike as jobs go through it.
+
+    Subclass and override the hooks you need, then pass instances to
+    Redbike(observers=[...]) or add_observer(). Hooks run inline, in the
+    dispatching or working thread, so keep them quick. With no
+    observers registered Redbike skips them entirely.
+    """
+
+    def on_dispatch_batch(self, shard, count, point_in_time):
+        """`count` due jobs were moved from a timeline shard to queues."""
+
+    def on_claim(self, claimed):
+        """A list of (jobid, jobtag) pairs was claimed from a queue."""
+
+    def on_work_start(self, jobid):
+        """The worker is about to work a job."""
+
+    def on_work_end(self, jobid, duration, outcome):
+        """The worker is done with a job.
+
+        `outcome` is completed, stopped, unset or died.
+        """
+
+    def on_reschedule(self, jobid, result):
+        """A worked job was rescheduled.
+
+        `result` is what reschedule() returned: None, or an RRULE to
+        refill the job's upcoming runs from.
+        """
+
+
+class SlowJobLogger(Observer):
+    """Logs a warning for jobs that take longer than `threshold` seconds."""
+
+    def __init__(self, threshold=10, log=None):
+        self.threshold = float(threshold)
+        self.log = log or logging.getLogger('redbike-slow-jobs')
+
+    def on_work_end(self, jobid, duration, outcome):
+        if duration > self.threshold:
+            self.log.warning("%s took %.3fs (%s)", jobid, duration, outcome)
+
+
+class ProfilingObserver(Observer):
+    """Profiles a sample of jobs with cProfile and logs the results.
+
+    Profiles roughly one job in `1 / sample_rate`, logging the top
+    `limit` functions by `sort`. Each thread is profiled separately.
+    """
+
+    def __init__(self, sample_rate=.01, sort='cumulative', limit=20,
+                 log=None):
+        self.sample_rate = float(sample_rate)
+        self.sort = sort
+        self.limit = int(limit)
+        self.log = log or logging.getLogger('redbike-profile')
+        self._local = threading.local()
+
+    def on_work_start(self, jobid):
+        if random.random() < self.sample_rate:
+            self._local.profile = cProfile.Profile()
+            self._local.profile.enable()
+
+    def on_work_end(self, jobid, duration, outcome):
+        profile = getattr(self._local, 'profile', None)
+        if profile is None:
+            return
+        profile.disable()
+        self._local.profile = None
+        out = StringIO()
+        stats = pstats.Stats(profile, stream=out)
+        stats.sort_stats(self.sort).print_stats(self.limit)
+        self.log.info("profile of %s (%.3fs, %s)\n%s",
+                      jobid, duration, outcome, out.getvalue())
@@ -0,0 +1,74 @@
+from collections import OrderedDict
+import threading
+
+from dateutil.rrule import rrulestr
+
+
+class _BadRRule(object):
+
+    def __init__(self, message):
+        self.message = message
+
+
+class RRuleCache(object):
+    """A bounded, thread-safe LRU cache of parsed rrules.
+
+    Keyed by schedule string. Schedules that fail to parse are cached
+    too, so they raise ValueError again without being parsed again.
+    Rules without a DTSTART start whenever they're parsed, so those
+    are parsed afresh each time rather than cached.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = int(maxsize)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._rrules = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._rrules)
+
+    def get(self, schedule):
+        if 'DTSTART' not in schedule.upper():
+            with self._lock:
+                self.misses += 1
+            return _checked(_parse(schedule))
+        with self._lock:
+            rrule = self._rrules.pop(schedule, None)
+            if rrule is not None:
+                self._rrules[schedule] = rrule  # most recently used last
+                self.hits += 1
+            else:
+                self.misses += 1
+        if rrule is None:
+            # Parse outside the lock. A racing thread might parse the
+            # same schedule too, which is harmless.
+            rrule = _parse(schedule)
+            with self._lock:
+                self._rrules[schedule] = rrule
+                while len(self._rrules) > self.maxsize:
+                    self._rrules.popitem(last=False)
+                    self.evictions += 1
+        return _checked(rrule)
+
+    def stats(self):
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self._rrules),
+                "maxsize": self.maxsize}
+
+
+def _parse(schedule):
+    try:
+        return rrulestr(schedule)
+    except ValueError as ex:
+        return _BadRRule(str(ex))
+
+
+def _checked(rrule):
+    if isinstance(rrule, _BadRRule):
+        raise ValueError(rrule.message)
+    return rrule
@@ -1,14 +1,25 @@
 
+import bisect
 import calendar
+from collections import namedtuple, OrderedDict
 import csv
-from datetime import datetime
+import heapq
+from datetime import datetime, timedelta
+from itertools import count, islice, repeat
 import logging
+import math
 import os
 import random
+import signal
+import threading
 import time
+import zlib
 
 import redis
-from dateutil.rrule import rrulestr
+
+from redbike.checkpoints import FileCheckpoint, RedisCheckpoint
+from redbike.metrics import Metrics
+from redbike.rrules import RRuleCache
 
 
 def _e(something):  # encode utf-8 if bytes. for py3 compat.
@@ -18,7 +29,13 @@ def _e(something):  # encode utf-8 if bytes. for py3 compat.
         return something
 
 
-SIGNALS = {"HALT": "HALT"}
+# Redis times out blocked clients on its cron, which by default runs
+# ten times a second, so a BRPOP can return up to this late. Waits that
+# need to be precise block until this long before they're up and sleep
+# the rest.
+WAKEUP_MARGIN = .15
+
+SIGNALS = {"HALT": "HALT", "PAUSE": "PAUSE", "RESUME": "RESUME"}
 
 
 class StopWork(Exception):
@@ -29,258 +46,1619 @@ class UnsetJob(Exception):
     """Unset the job from the queue."""
 
 
-ENQUEUE_LUA = """
-local workqueue = ARGV[1]
-local jobid = ARGV[2]
-local timestamp = tonumber(ARGV[3])
-local is_working_key = workqueue .. "-" .. jobid
-local members_key = workqueue .. "-members", jobid
-if (redis.call("SISMEMBER", members_key, jobid) == 0
-    and redis.call("GET", is_working_key) == false) then
-   redis.call("LPUSH", workqueue, jobid)
-   redis.call("SADD", workqueue .. "-members", jobid)
-   redis.call("HSET", redbike.statuses_key, jobid, "ENQ:" .. timestamp)
-   return timestamp
+# The keys every script is passed first, as KEYS[1] to KEYS[5]. Any
+# keys a script needs of its own follow. Keys a script derives (event
+# indexes, queue member sets, is-working keys) share the hash tag of
+# the keys it is passed, so in cluster mode they're in the same slot.
+ShardKeys = namedtuple('ShardKeys', ['statuses_key', 'status_index_key',
+                                     'schedules_key', 'timeline_key',
+                                     'wakeup_key'])
+
+# Included in every script. Keeps the statuses hash and the sorted sets
+# indexing it by timestamp (and by event, if enabled) in step.
+STATUS_FUNC_LUA = """
+local function unset_status(jobid)
+   local status = redis.call("HGET", redbike.statuses_key, jobid)
+   if status and redbike.index_events then
+      redis.call("ZREM", redbike.status_index_key .. "-" ..
+                 string.match(status, "^[^:]*"), jobid)
+   end
+   redis.call("ZREM", redbike.status_index_key, jobid)
+   redis.call("HDEL", redbike.statuses_key, jobid)
+end
+local function set_status(jobid, event, timestamp)
+   unset_status(jobid)
+   redis.call("HSET", redbike.statuses_key, jobid, event .. ":" .. timestamp)
+   redis.call("ZADD", redbike.status_index_key, timestamp, jobid)
+   if redbike.index_events then
+      redis.call("ZADD", redbike.status_index_key .. "-" .. event,
+                 timestamp, jobid)
+   end
 end"""
 
-CONSUME_LUA = """
-local workqueue = ARGV[1]
-local timeout_seconds = ARGV[2]
+SET_STATUS_LUA = """
+set_status(ARGV[1], ARGV[2], tonumber(ARGV[3]))"""
+
+UNSET_STATUS_LUA = """
+unset_status(ARGV[1])"""
+
+# Leaves a token on the queue's ready list for blocked workers to wake
+# on. They claim through the consume script, so a job is only ever off
+# its queue once it's claimed. A job held back for the queue isn't any
+# more.
+ENQUEUE_FUNC_LUA = """
+local function enqueue(workqueue, jobid, timestamp)
+   redis.call("ZREM", workqueue .. "-held", jobid)
+   local is_working_key = workqueue .. "-" .. jobid
+   local members_key = workqueue .. "-members"
+   if (redis.call("SISMEMBER", members_key, jobid) == 0
+       and redis.call("GET", is_working_key) == false) then
+      redis.call("LPUSH", workqueue, jobid)
+      redis.call("LPUSH", workqueue .. "-ready", 1)
+      redis.call("SADD", members_key, jobid)
+      set_status(jobid, "ENQ", timestamp)
+      return timestamp
+   end
+end"""
+
+ENQUEUE_LUA = ENQUEUE_FUNC_LUA + """
+return enqueue(KEYS[6], ARGV[1], tonumber(ARGV[2]))"""
+
+# Needs a queue_for(jobid) Lua function, supplied by the worker class
+# (see RoundRobin.queue_for_lua), to route due jobs server-side.
+# Looks at up to `limit` due jobs. ARGV[5] on are (queue, mark) pairs,
+# the mark empty for queues without one. Jobs bound for a queue at its
+# mark are moved off the timeline to the queue's held set, keeping
+# their scores, so they aren't read past again on every pass. A queue's
+# held jobs go out first, oldest first, as it has room. Returns the
+# timeline scores of the jobs it took and the number it held back.
+DISPATCH_LUA = ENQUEUE_FUNC_LUA + """
+local point_in_time = tonumber(ARGV[1])
+local limit = tonumber(ARGV[2])
 local timestamp = tonumber(ARGV[3])
-local jobtag = ARGV[4]
-local jobid = redis.call("RPOP", workqueue)
-if jobid ~= false then
+local keyspace = ARGV[4]
+local room = {}
+local scores = {}
+for i = 5, #ARGV, 2 do
+   local workqueue = ARGV[i]
+   local mark = tonumber(ARGV[i + 1])
+   local count = limit - #scores
+   if mark then
+      room[workqueue] = mark - redis.call("LLEN", workqueue)
+      count = math.min(count, room[workqueue])
+   end
+   if count > 0 then
+      local waiting = redis.call("ZRANGE", workqueue .. "-held", 0,
+                                 count - 1, "WITHSCORES")
+      for j = 1, #waiting, 2 do
+         if enqueue(workqueue, waiting[j], timestamp) and mark then
+            room[workqueue] = room[workqueue] - 1
+         end
+         table.insert(scores, waiting[j + 1])
+      end
+   end
+end
+local held = 0
+if #scores < limit then
+   local due = redis.call("ZRANGEBYSCORE", redbike.timeline_key, 0,
+                          point_in_time, "WITHSCORES", "LIMIT", 0,
+                          limit - #scores)
+   for i = 1, #due, 2 do
+      local jobid = due[i]
+      local workqueue = keyspace .. "-" .. queue_for(jobid)
+      redis.call("ZREM", redbike.timeline_key, jobid)
+      if room[workqueue] and room[workqueue] <= 0 then
+         redis.call("ZADD", workqueue .. "-held", due[i + 1], jobid)
+         held = held + 1
+      else
+         if enqueue(workqueue, jobid, timestamp) and room[workqueue] then
+            room[workqueue] = room[workqueue] - 1
+         end
+         table.insert(scores, due[i + 1])
+      end
+   end
+end
+return {scores, held}"""
+
+# Releases jobs a prefetching dispatcher read ahead, as ARGV[3] on:
+# ARGV[2] (jobid, timeline score, queue) triples, then (queue, mark)
+# pairs for queues with a high-water mark. Jobs moved or removed from
+# the timeline since they were read are left alone, as are jobs bound
+# for a full queue or one with jobs held back, which go out first.
+# Returns the scores of the jobs it took and the number it left due.
+RELEASE_LUA = ENQUEUE_FUNC_LUA + """
+local timestamp = tonumber(ARGV[1])
+local last = 2 + 3 * tonumber(ARGV[2])
+local room = {}
+for i = last + 1, #ARGV, 2 do
+   room[ARGV[i]] = tonumber(ARGV[i + 1]) - redis.call("LLEN", ARGV[i])
+   if redis.call("EXISTS", ARGV[i] .. "-held") == 1 then
+      room[ARGV[i]] = 0
+   end
+end
+local scores = {}
+local held = 0
+for i = 3, last, 3 do
+   local jobid = ARGV[i]
+   local workqueue = ARGV[i + 2]
+   local score = redis.call("ZSCORE", redbike.timeline_key, jobid)
+   if score and tonumber(score) == tonumber(ARGV[i + 1]) then
+      if room[workqueue] and room[workqueue] <= 0 then
+         held = held + 1
+      else
+         redis.call("ZREM", redbike.timeline_key, jobid)
+         if enqueue(workqueue, jobid, timestamp) and room[workqueue] then
+            room[workqueue] = room[workqueue] - 1
+         end
+         table.insert(scores, score)
+      end
+   end
+end
+return {scores, held}"""
+
+# Leaves a token on the wakeup list when the job lands at the head of
+# the timeline so a sleeping dispatcher notices it is due sooner, or
+# inside the window a prefetching dispatcher has read ahead so it reads
+# it again. A job held back for its queue isn't any more.
+TIMELINE_FUNC_LUA = """
+local function add_to_timeline(workqueue, jobid, timestamp, now)
+   set_status(jobid, "TML", now)
+   redis.call("ZREM", workqueue .. "-held", jobid)
+   redis.call("ZADD", redbike.timeline_key, timestamp, jobid)
+   local horizon = redis.call("GET", redbike.wakeup_key .. "-horizon")
+   if (redis.call("ZRANGE", redbike.timeline_key, 0, 0)[1] == jobid or
+       (horizon and timestamp <= tonumber(horizon))) then
+      redis.call("LPUSH", redbike.wakeup_key, timestamp)
+      redis.call("LTRIM", redbike.wakeup_key, 0, 0)
+   end
+end"""
+
+TIMELINE_LUA = TIMELINE_FUNC_LUA + """
+add_to_timeline(KEYS[6], ARGV[1], tonumber(ARGV[2]), tonumber(ARGV[3]))"""
+
+# Returns the job's status before it was claimed.
+CLAIM_FUNC_LUA = """
+local function claim(workqueue, jobid, timeout_seconds, timestamp, jobtag)
    local is_working_key = workqueue .. "-" .. jobid
-   local members_key = workqueue .. "-members", jobid
-   redis.call("SREM", members_key, jobid)
+   local status = redis.call("HGET", redbike.statuses_key, jobid)
+   redis.call("SREM", workqueue .. "-members", jobid)
    redis.call("SET", is_working_key, jobtag)
    redis.call("EXPIRE", is_working_key, timeout_seconds)
-   redis.call("HSET", redbike.statuses_key, jobid, "WRK:" .. timestamp)
+   set_status(jobid, "WRK", timestamp)
+   return status
+end"""
+
+# Claims up to one job per jobtag passed from ARGV[5] on. If the queue
+# has a rate limit (ARGV[3] claims per second, in bursts of up to
+# ARGV[4]) claims are also limited by a token bucket, refilled by the
+# time passed since its last claim going by the server's clock, so
+# workers' clocks can't drift it. Before Redis 5 a script has to switch
+# to replicating its effects before it can write after TIME.
+# Trims the queue's ready list to no more tokens than jobs left. Returns
+# the claimed jobids and their statuses before they were claimed.
+CONSUME_LUA = CLAIM_FUNC_LUA + """
+local workqueue = KEYS[6]
+local now = tonumber(ARGV[2])
+local rate = tonumber(ARGV[3])
+local last = #ARGV
+local tokens, clock
+if rate then
+   if redis.replicate_commands then
+      redis.replicate_commands()
+   end
+   local time = redis.call("TIME")
+   clock = tonumber(time[1]) + tonumber(time[2]) / 1000000
+   local burst = tonumber(ARGV[4])
+   local bucket = redis.call("HMGET", workqueue .. "-bucket", "tokens", "at")
+   local at = tonumber(bucket[2]) or clock
+   tokens = math.min(burst, (tonumber(bucket[1]) or burst) +
+                            math.max(0, clock - at) * rate)
+   last = math.min(last, 4 + math.floor(tokens))
+end
+local jobids = {}
+local statuses = {}
+for i = 5, last do
+   local jobid = redis.call("RPOP", workqueue)
+   if jobid == false then
+      break
+   end
+   table.insert(statuses, claim(workqueue, jobid, ARGV[1], now, ARGV[i]))
+   table.insert(jobids, jobid)
+end
+if rate then
+   local bucket_key = workqueue .. "-bucket"
+   redis.call("HMSET", bucket_key, "tokens", tokens - #jobids,
+              "at", clock)
+   redis.call("EXPIRE", bucket_key,
+              math.ceil(tonumber(ARGV[4]) / rate) + 1)
 end
-return jobid"""
+local left = redis.call("LLEN", workqueue)
+if left == 0 then
+   redis.call("DEL", workqueue .. "-ready")
+else
+   redis.call("LTRIM", workqueue .. "-ready", 0, left - 1)
+end
+return {jobids, statuses}"""
+
+RECYCLE_LUA = """
+if redis.call("GET", KEYS[6]) == ARGV[1] then
+   return redis.call("DEL", KEYS[6])
+end
+return 0"""
+
+# Releases the is-working key if we still hold it and schedules the
+# job's next run. RRULE runs come from the job's upcoming window; once
+# that runs out the RRULE is returned for the client to refill it.
+RESCHEDULE_LUA = ENQUEUE_FUNC_LUA + TIMELINE_FUNC_LUA + """
+local is_working_key = KEYS[6]
+local workqueue = KEYS[7]
+local upcoming_key = KEYS[8]
+local jobtag = ARGV[1]
+local jobid = ARGV[2]
+local now = tonumber(ARGV[3])
+local backoff = tonumber(ARGV[4])
+if redis.call("GET", is_working_key) ~= jobtag then
+   return
+end
+redis.call("DEL", is_working_key)
+local schedule = redis.call("HGET", redbike.schedules_key, jobid)
+if schedule == false then
+   unset_status(jobid)
+   redis.call("ZREM", redbike.timeline_key, jobid)
+   redis.call("ZREM", workqueue .. "-held", jobid)
+   redis.call("LREM", workqueue, 0, jobid)
+   redis.call("DEL", upcoming_key)
+elseif schedule == "STOP" then
+   set_status(jobid, "STP", now)
+elseif schedule == "CONTINUE" and backoff and backoff ~= 0 then
+   add_to_timeline(workqueue, jobid, now + backoff, now)
+elseif schedule == "CONTINUE" then
+   enqueue(workqueue, jobid, now)
+elseif schedule == "NOW" then
+   redis.call("HSET", redbike.schedules_key, jobid, "STOP")
+   enqueue(workqueue, jobid, now)
+elseif string.sub(schedule, 1, 3) == "AT:" then
+   redis.call("HSET", redbike.schedules_key, jobid, "STOP")
+   local at = tonumber(string.match(schedule, "^AT:([^:]*)"))
+   if at then
+      add_to_timeline(workqueue, jobid, at, now)
+   else
+      set_status(jobid, "BAD", now)
+   end
+else
+   local next_run = redis.call("LPOP", upcoming_key)
+   while next_run and tonumber(next_run) <= now do
+      next_run = redis.call("LPOP", upcoming_key)
+   end
+   if not next_run then
+      return schedule
+   end
+   add_to_timeline(workqueue, jobid, tonumber(next_run), now)
+end"""
+
+
+ROUND_ROBIN_QUEUE_FOR_LUA = """
+local function queue_for(jobid)
+   return "work-" .. string.match(jobid, "[^:]*$")
+end"""
 
 
 class Redbike(object):
 
     def __init__(self, worker, prefix=None, redis_config=None, timefile=None,
-                 log=None, stop_event=None, default_timeout=10):
+                 log=None, stop_event=None, default_timeout=10,
+                 dispatch_limit=1000, max_sleep=1, block_timeout=1,
+                 batch_size=1, rrule_cache_size=1024, lookahead=10,
+                 scan_count=1000, index_events=True, concurrency=1,
+                 executor='thread', shards=1, cluster=False, metrics=None,
+                 observers=None, default_high_water=None, listen=True,
+                 default_spread=None, spread_mode='hash', prefetch=0,
+                 checkpoint=None, checkpoint_interval=1):
         self.worker = worker
         self.prefix = prefix or 'redbike'
-        self.redis = redis.StrictRedis(**(redis_config or {}))
+        self.cluster = _bool(cluster)
+        self.redis = self.connect(redis_config or {})
         self.timefile = timefile or '.redbike.timefile'
         self.log = log if log else logging.getLogger('redbike-%s' % prefix)
         self.stop_event = stop_event
         self.default_timeout = default_timeout
+        self.default_high_water = default_high_water
+        self.default_spread = default_spread
+        if spread_mode not in ('hash', 'random'):
+            raise ValueError("spread_mode must be hash or random")
+        self.spread_mode = spread_mode
+        self.dispatch_limit = int(dispatch_limit)
+        self.max_sleep = float(max_sleep)
+        self.prefetch = float(prefetch)
+        self.block_timeout = int(block_timeout)
+        self.batch_size = int(batch_size)
+        self.rrules = RRuleCache(rrule_cache_size)
+        self.lookahead = int(lookahead)
+        self.scan_count = int(scan_count)
+        self.index_events = _bool(index_events)
+        self.concurrency = int(concurrency)
+        self.executor = executor
+        self.shards = int(shards)
+        self.metrics = metrics or Metrics()
+        self.observers = list(observers or [])
         self.statuses_key = '%s-statuses' % self.prefix
+        self.status_index_key = '%s-statuses-at' % self.prefix
         self.schedules_key = '%s-schedules' % self.prefix
         self.timeline_key = '%s-timeline' % self.prefix
         self.control_key = '%s-control' % self.prefix
+        self.paused_key = '%s-paused' % self.prefix
+        self.listen = _bool(listen)
+        self.paused = set()
+        self._control_thread = None
+        self._halted_by_control = False
+        self._fractional_timeouts = None
+        self.wakeup_key = '%s-wakeup' % self.prefix
+        self.checkpoint_key = '%s-checkpoint' % self.prefix
+        if checkpoint in (None, 'file'):
+            checkpoint = FileCheckpoint(self.timefile)
+        elif checkpoint == 'redis':
+            checkpoint = RedisCheckpoint(self.redis, self.checkpoint_key)
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = float(checkpoint_interval)
+        self.set_status_script = self._register_script(SET_STATUS_LUA)
+        self.unset_status_script = self._register_script(UNSET_STATUS_LUA)
+        self.timeline_script = self._register_script(TIMELINE_LUA)
         self.enqueue_script = self._register_script(ENQUEUE_LUA)
         self.consume_script = self._register_script(CONSUME_LUA)
+        self.recycle_script = self._register_script(RECYCLE_LUA)
+        self.reschedule_script = self._register_script(RESCHEDULE_LUA)
+        self.release_script = self._register_script(RELEASE_LUA)
+        queue_for_lua = getattr(self.worker, 'queue_for_lua', None)
+        if queue_for_lua:
+            self.dispatch_script = self._register_script(
+                queue_for_lua + DISPATCH_LUA)
+        else:
+            self.dispatch_script = None
         # Capture queue_name generator here so that after halting
         # subsequent calls to work() don't just keep hitting the first queue.
+        self._blocking_shard = count()
         self.consumer = self.consumer_generator()
 
+    def connect(self, redis_config):
+        if self.cluster:
+            if not hasattr(redis, 'RedisCluster'):
+                raise ImportError("Cluster mode needs redis-py 4.1 or later.")
+            return redis.RedisCluster(**redis_config)
+        return redis.StrictRedis(**redis_config)
+
+    def pipeline(self):
+        """A pipeline for commands and scripts that needn't be atomic.
+
+        In cluster mode, where redis-py won't pipeline scripts, commands
+        are run as they're queued instead.
+        """
+        if self.cluster:
+            return _Unpipelined(self.redis)
+        return self.redis.pipeline(transaction=False)
+
     def _register_script(self, lua):
-        redbike_env = {"statuses_key": self.statuses_key}
+        redbike_env = {"index_events": self.index_events}
         redbike_env_lua = "local redbike = {%s}" % ",".join(
-            "=".join([k, repr(v)]) for k, v in redbike_env.items())
-        return self.redis.register_script(redbike_env_lua + lua)
+            ["=".join([k, _lua(v)]) for k, v in redbike_env.items()] +
+            ["%s=KEYS[%s]" % (name, i + 1)
+             for i, name in enumerate(ShardKeys._fields)])
+        return self.redis.register_script(
+            redbike_env_lua + STATUS_FUNC_LUA + lua)
+
+    def add_observer(self, observer):
+        """Register an Observer to have its hooks called."""
+        self.observers.append(observer)
+
+    def notify(self, hook, *args):
+        for observer in self.observers:
+            # An observer failing mustn't lose jobs or stop the process.
+            try:
+                getattr(observer, hook)(*args)
+            except Exception:
+                self.log.exception("%s.%s failed",
+                                   type(observer).__name__, hook)
+
+    def control(self, signal, queue_name=None):
+        """Signal dispatchers and workers.
 
-    def control(self, signal):
-        self.redis.set(self.control_key, SIGNALS[signal.upper()])
+        HALT is kept in the control key. PAUSE and RESUME take the name
+        of a queue, as the worker names it, and keep a set of paused
+        queues. Either way the signal is also published on the control
+        channel, for processes listening for it.
+        """
+        signal = SIGNALS[signal.upper()]
+        if signal == "HALT":
+            self.redis.set(self.control_key, signal)
+            message = signal
+        elif queue_name is None:
+            raise ValueError("%s needs a queue name" % signal)
+        else:
+            if signal == "PAUSE":
+                self.redis.sadd(self.paused_key, queue_name)
+            else:
+                self.redis.srem(self.paused_key, queue_name)
+            message = "%s:%s" % (signal, queue_name)
+        self.redis.publish(self.control_key, message)
 
     def is_halted(self):
         if self.stop_event is not None and self.stop_event.is_set():
             return True  # pragma: no cover
-        return _e(self.redis.get(self.control_key)) == "HALT"
+        if self._control_thread is not None:
+            if self._control_thread.is_alive():
+                return False  # the listener sets stop_event on HALT
+            self.log.warn("control listener died, checking the key")
+            self._control_thread = None
+        return self.sync_control()
 
     def clear_control(self):
         self.redis.delete(self.control_key)
+        self.redis.publish(self.control_key, "CLEAR")
+        self._set_halted(False)
+
+    def sync_control(self):
+        """Read the control key and paused queues.
+
+        Returns True if halted.
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.get(self.control_key)
+        pipe.smembers(self.paused_key)
+        control, paused = pipe.execute()
+        self.paused = set(map(_e, paused))
+        return _e(control) == "HALT"
 
-    def set_status(self, jobid, event, timestamp=None):
+    def listen_for_control(self):
+        """Follow control signals from a background thread.
+
+        Saves checking the control key after every job: on HALT the
+        thread sets `stop_event` instead. Returns once subscribed.
+        """
+        if self._control_thread is not None:
+            return
+        if self.stop_event is None:
+            self.stop_event = threading.Event()
+        subscribed = threading.Event()
+        self._control_thread = threading.Thread(
+            target=self._follow_control, args=(subscribed,))
+        self._control_thread.daemon = True
+        self._control_thread.start()
+        subscribed.wait(10)
+
+    def _follow_control(self, subscribed):
+        wait = 1
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.control_key)
+                # Catch up on anything sent before we subscribed.
+                self._set_halted(self.sync_control())
+                subscribed.set()
+                wait = 1
+                for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        self.apply_control(_e(message['data']))
+            except Exception as ex:
+                self.log.exception(ex)
+            # Back off while Redis is down, up to half a minute.
+            self.log.warn("control channel lost, resubscribing in %ss", wait)
+            time.sleep(wait)
+            wait = min(wait * 2, 30)
+
+    def apply_control(self, message):
+        signal, _, queue_name = message.partition(':')
+        if signal == "HALT":
+            self._set_halted(True)
+        elif signal == "CLEAR":
+            self._set_halted(False)
+        elif signal == "PAUSE":
+            self.paused.add(queue_name)
+        elif signal == "RESUME":
+            self.paused.discard(queue_name)
+
+    def _set_halted(self, halted):
+        if halted and self.stop_event is not None:
+            self._halted_by_control = True
+            self.stop_event.set()
+        elif not halted and self._halted_by_control:
+            # Only undo a stop we made, not one from a signal.
+            self._halted_by_control = False
+            self.stop_event.clear()
+
+    def paused_queues(self):
+        """Full names of the paused queues we consume."""
+        if not self.paused:
+            return set()
+        return set("%s-%s" % (self.keyspace(shard), queue_name)
+                   for shard in self.data_shards()
+                   for queue_name in self.paused)
+
+    def set_status(self, jobid, event, timestamp=None, client=None):
         if timestamp is None:
             timestamp = time.time()
-        self.redis.hset(self.statuses_key,
-                        jobid,
-                        "%s:%s" % (event, int(timestamp)))
+        self.set_status_script(keys=self.keys_for(jobid),
+                               args=[jobid, event, _ms(timestamp)],
+                               client=client)
+
+    def set_schedule(self, jobid, schedule, client=None):
+        client = client or self.redis
+        client.hset(self.keys_for(jobid).schedules_key, jobid, schedule)
+        client.delete(self.upcoming_key(jobid))
 
-    def set_schedule(self, jobid, schedule):
-        self.redis.hset(self.schedules_key, jobid, schedule)
+    def upcoming_key(self, jobid):
+        return "%s-upcoming-%s" % (self.keyspace(self.shard_of(jobid)),
+                                   _e(jobid))
+
+    def set_upcoming(self, jobid, runs, client=None):
+        """Store the runs after the next one, for reschedule() to use."""
+        client = client or self.redis
+        client.delete(self.upcoming_key(jobid))
+        if runs:
+            client.rpush(self.upcoming_key(jobid), *runs)
 
     def set(self, jobid, schedule, after=None):
         self.set_schedule(jobid, schedule)
         self.schedule(jobid, schedule, after=after)
 
-    def unset(self, jobid):
-        self.redis.hdel(self.statuses_key, jobid)
-        self.redis.hdel(self.schedules_key, jobid)
-        self.redis.zrem(self.timeline_key, jobid)
-        self.remove_from_queue(jobid)
+    def unset(self, jobid, client=None):
+        client = client or self.redis
+        keys = self.keys_for(jobid)
+        self.unset_status_script(keys=keys, args=[jobid], client=client)
+        client.hdel(keys.schedules_key, jobid)
+        client.zrem(keys.timeline_key, jobid)
+        client.zrem(self.held_key(self.queue_for(jobid)), jobid)
+        client.delete(self.upcoming_key(jobid))
+        self.remove_from_queue(jobid, client=client)
+
+    def shard_of(self, jobid):
+        return ((zlib.crc32(_e(jobid).encode('utf-8')) & 0xffffffff) %
+                self.shards)
+
+    def keyspace(self, shard):
+        """What a shard's key names start with.
+
+        In cluster mode that's a hash tag of its own, so each shard's
+        keys live together in one slot.
+        """
+        if self.cluster:
+            return "{%s-%s}" % (self.prefix, shard)
+        return self.prefix
+
+    def shard_keys(self, shard):
+        """The ShardKeys of a shard.
+
+        Only the timeline is sharded outside of cluster mode.
+        """
+        keyspace = self.keyspace(shard)
+        timeline_key = '%s-timeline' % keyspace
+        wakeup_key = '%s-wakeup' % keyspace
+        if self.shards > 1 and not self.cluster:
+            timeline_key = '%s-%s' % (timeline_key, shard)
+            wakeup_key = '%s-%s' % (wakeup_key, shard)
+        return ShardKeys('%s-statuses' % keyspace,
+                         '%s-statuses-at' % keyspace,
+                         '%s-schedules' % keyspace,
+                         timeline_key, wakeup_key)
 
-    def add_to_timeline(self, jobid, timestamp):
-        self.set_status(jobid, 'TML')
-        self.redis.zadd(self.timeline_key, int(timestamp), jobid)
+    def keys_for(self, jobid):
+        return self.shard_keys(self.shard_of(jobid))
+
+    def data_shards(self):
+        """Shards with statuses and schedules of their own."""
+        return range(self.shards) if self.cluster else [0]
+
+    def timeline_for(self, jobid):
+        return self.keys_for(jobid).timeline_key
+
+    def add_to_timeline(self, jobid, timestamp, client=None):
+        self.timeline_script(
+            keys=list(self.keys_for(jobid)) + [self.queue_for(jobid)],
+            args=[jobid, _ms(timestamp), _ms(time.time())], client=client)
 
     def queue_for(self, jobid):
-        return "%s-%s" % (self.prefix, self.worker.queue_for(jobid))
+        return "%s-%s" % (self.keyspace(self.shard_of(jobid)),
+                          self.worker.queue_for(jobid))
 
-    def enqueue(self, jobid):
+    def enqueue(self, jobid, client=None):
         self.enqueue_script(
-            args=[self.queue_for(jobid), jobid, int(time.time())])
+            keys=list(self.keys_for(jobid)) + [self.queue_for(jobid)],
+            args=[jobid, _ms(time.time())], client=client)
 
-    def schedule(self, jobid, schedule, after=None, backoff=None):
+    def schedule(self, jobid, schedule, after=None, backoff=None,
+                 client=None):
         jobid = _e(jobid)
         schedule = _e(schedule)
         if schedule is None:
-            self.unset(jobid)
+            self.unset(jobid, client=client)
         elif schedule == 'STOP':
-            self.set_status(jobid, 'STP')
+            self.set_status(jobid, 'STP', client=client)
         elif schedule == 'CONTINUE' and backoff:
-            self.add_to_timeline(jobid, int(time.time()) + backoff)
+            self.add_to_timeline(jobid, time.time() + float(backoff),
+                                 client=client)
         elif schedule == 'CONTINUE':
-            self.enqueue(jobid)
+            self.enqueue(jobid, client=client)
         elif schedule == 'NOW':
-            self.set_schedule(jobid, 'STOP')
-            self.enqueue(jobid)
+            self.set_schedule(jobid, 'STOP', client=client)
+            self.enqueue(jobid, client=client)
         elif schedule.startswith("AT:"):
-            self.set_schedule(jobid, 'STOP')
-            self.add_to_timeline(jobid, schedule.split(":")[1])
+            self.set_schedule(jobid, 'STOP', client=client)
+            try:
+                at = float(schedule.split(":")[1])
+            except ValueError:
+                self.set_status(jobid, 'BAD', client=client)
+                self.log.warn("%s Bad AT: time", jobid)
+                return
+            self.add_to_timeline(jobid, at, client=client)
         else:
-            after_dt = (datetime.fromtimestamp(after)
-                        if after else datetime.utcnow())
             try:
-                rrule = rrulestr(schedule)
-                next_run_dt = rrule.after(after_dt)
-                if next_run_dt:
-                    next_run = calendar.timegm(next_run_dt.timetuple())
-                    self.add_to_timeline(jobid, next_run)
-                else:
-                    self.set_status(jobid, 'STP')
+                runs = self.next_runs(schedule, after=after, jobid=jobid)
             except ValueError:
-                self.set_status(jobid, 'BAD')
+                self.set_status(jobid, 'BAD', client=client)
                 self.log.warn("%s Bad RRULE", jobid)
+                return
+            if runs:
+                self.add_to_timeline(jobid, runs[0], client=client)
+                self.set_upcoming(jobid, runs[1:], client=client)
+            else:
+                self.set_status(jobid, 'STP', client=client)
+
+    def next_runs(self, schedule, after=None, jobid=None):
+        """Timestamps of the next `lookahead` runs of an RRULE.
+
+        Given a jobid, each run is offset by up to the job's spread().
+        Raises ValueError if the RRULE is bad.
+        """
+        after_dt = (datetime.utcfromtimestamp(after)
+                    if after else datetime.utcnow())
+        rrule = self.rrules.get(schedule)
+        window = self.spread(jobid) if jobid is not None else None
+        if not window:
+            return [_ms(_timestamp(run_dt))
+                    for run_dt in islice(rrule.xafter(after_dt),
+                                         self.lookahead)]
+        window = float(window)
+        offsets = self.spread_offsets(jobid, window)
+        after = _timestamp(after_dt)
+        # Runs up to a window early may be offset past `after`, and a
+        # later run may be offset ahead of an earlier one.
+        runs = []
+        for run_dt in rrule.xafter(after_dt - timedelta(seconds=window)):
+            run = _timestamp(run_dt)
+            if len(runs) >= self.lookahead and run > runs[-1]:
+                break
+            run = _ms(run + next(offsets))
+            if run > after:
+                bisect.insort(runs, run)
+                del runs[self.lookahead:]
+        return runs
+
+    def spread(self, jobid):
+        """Seconds over which to spread a job's runs, or None."""
+        # Optional, so workers written before it keep working.
+        worker_spread = getattr(self.worker, 'spread', None)
+        spread = worker_spread(jobid) if worker_spread else None
+        if spread is None:
+            spread = self.default_spread
+        return spread
+
+    def spread_offsets(self, jobid, window):
+        """Offsets for a job's runs, each within [0, window).
 
-    def reschedule(self, jobid, jobtag, backoff=None):
-        if self.recycle(jobid, jobtag):
-            schedule = self.redis.hget(self.schedules_key, jobid)
-            self.schedule(jobid, schedule, backoff=backoff)
+        In hash mode every run of a job gets the same offset, taken from
+        a hash of the jobid, so its runs keep their spacing. In random
+        mode each run gets its own.
+        """
+        if self.spread_mode == 'random':
+            return iter(lambda: random.random() * window, None)
+        slots = max(int(window * 1000), 1)
+        crc = zlib.crc32(('spread:%s' % jobid).encode('utf-8')) & 0xffffffff
+        return repeat((crc % slots) / 1000.0)
 
-    def load_csv(self, csvfilename):
-        with open(csvfilename) as csvfile:
-            reader = csv.reader(csvfile)
-            for jobid, schedule in reader:
-                self.set(jobid, schedule)
+    def reschedule(self, jobid, jobtag, backoff=None, client=None):
+        """Schedule a worked job's next run if it's still ours to.
+
+        Returns the job's schedule if its upcoming runs have run out and
+        it's an RRULE, after scheduling its next runs from it. Piped,
+        this is the pipeline's result, and scheduling the next runs is
+        left to the caller.
+        """
+        keys = list(self.keys_for(jobid)) + [
+            self.is_working_key(jobid), self.queue_for(jobid),
+            self.upcoming_key(jobid)]
+        args = [jobtag, jobid, _ms(time.time()), backoff or '']
+        result = self.reschedule_script(keys=keys, args=args, client=client)
+        if client is None and result is not None:
+            self.schedule(jobid, result)
+        return result
+
+    def valid_schedule(self, schedule):
+        schedule = _e(schedule)
+        if schedule in (None, 'STOP', 'CONTINUE', 'NOW'):
+            return True
+        if schedule.startswith("AT:"):
+            try:
+                float(schedule.split(":")[1])
+                return True
+            except ValueError:
+                return False
+        try:
+            self.rrules.get(schedule)
+            return True
+        except ValueError:
+            return False
+
+    def set_many(self, rows, after=None, chunk_size=1000, progress=None):
+        """Set (jobid, schedule) pairs, pipelined in chunks.
+
+        Rows that aren't pairs are skipped. Rows with bad schedules are
+        set anyway, like set() would. Both count as bad. If given,
+        `progress` is called with the count of rows and bad rows so far
+        after each chunk. Returns those counts once rows run out.
+        """
+        count = bad = 0
+        rows = iter(rows)
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                return count, bad
+            pipe = self.pipeline()
+            for row in chunk:
+                count += 1
+                if len(row) != 2:
+                    bad += 1
+                    self.log.warn("Skipping bad row %s: %r", count, row)
+                    continue
+                jobid, schedule = row
+                if not self.valid_schedule(schedule):
+                    bad += 1
+                self.set_schedule(jobid, schedule, client=pipe)
+                self.schedule(jobid, schedule, after=after, client=pipe)
+            pipe.execute()
+            if progress is not None:
+                progress(count, bad)
+
+    def load_csv(self, csvfile, after=None, chunk_size=1000, progress=None):
+        """Set jobs from a CSV of JOBID,SCHEDULE rows.
+
+        Takes a file name or an open file.
+        """
+        if not hasattr(csvfile, 'read'):
+            with open(csvfile) as csvfile:
+                return self.load_csv(csvfile, after=after,
+                                     chunk_size=chunk_size,
+                                     progress=progress)
+        return self.set_many(csv.reader(csvfile), after=after,
+                             chunk_size=chunk_size, progress=progress)
 
     def point_in_time(self):
-        if os.path.exists(self.timefile):
-            with open(self.timefile) as timefile:
-                return int(timefile.read())
-        else:
+        """The last checkpoint the dispatcher wrote, or else now."""
+        point_in_time = self.checkpoint.read()
+        if point_in_time is None:
             return time.time()
+        return point_in_time
+
+    def dispatch_due(self, point_in_time, shard=0):
+        """Move up to `dispatch_limit` due jobs from timeline to queues.
+
+        Returns the number of jobs taken off the timeline shard.
+        """
+        return self.dispatch_page(point_in_time, shard=shard)[0]
+
+    def dispatch_page(self, point_in_time, shard=0):
+        """Look at up to `dispatch_limit` due jobs.
+
+        Jobs bound for queues at their high-water mark are moved to the
+        queue's held set, and go out ahead of the timeline once it has
+        room. Returns the numbers of jobs taken and held back.
+        """
+        high_waters = self.shard_high_waters(shard)
+        if self.dispatch_script is not None:
+            args = [_ms(point_in_time), self.dispatch_limit,
+                    _ms(time.time()), self.keyspace(shard)]
+            for queue_name, high_water in high_waters.items():
+                args += [queue_name, '' if high_water is None else high_water]
+            scores, held = self.dispatch_script(keys=self.shard_keys(shard),
+                                                args=args)
+        else:
+            # The worker can't route server-side, so do it from here.
+            room = {queue_name: high_water - self.redis.llen(queue_name)
+                    for queue_name, high_water in high_waters.items()
+                    if high_water is not None}
+            scores = self._release_held(high_waters, room)
+            held = self._dispatch_due_here(point_in_time, shard, room,
+                                           scores)
+        self.record_dispatched(scores)
+        if self.observers:
+            self.notify('on_dispatch_batch', shard, len(scores),
+                        point_in_time)
+        return len(scores), held
+
+    def _release_held(self, high_waters, room):
+        """Enqueue held back jobs while their queues have room.
+
+        Returns their timeline scores.
+        """
+        scores = []
+        for queue_name in high_waters:
+            count = min(self.dispatch_limit - len(scores),
+                        room.get(queue_name, self.dispatch_limit))
+            if count <= 0:
+                continue
+            for jobid, score in self.redis.zrange(
+                    self.held_key(queue_name), 0, count - 1,
+                    withscores=True):
+                self.enqueue(jobid)
+                if queue_name in room:
+                    room[queue_name] -= 1
+                scores.append(score)
+        return scores
+
+    def _dispatch_due_here(self, point_in_time, shard, room, scores):
+        """Enqueue due jobs, or hold them back if their queue is full.
+
+        Adds the scores of the jobs enqueued to `scores` and returns
+        the number held back.
+        """
+        if len(scores) >= self.dispatch_limit:
+            return 0
+        timeline_key = self.shard_keys(shard).timeline_key
+        held = 0
+        for jobid, score in self.redis.zrangebyscore(
+                timeline_key, 0, point_in_time, start=0,
+                num=self.dispatch_limit - len(scores), withscores=True):
+            queue_name = self.queue_for(jobid)
+            self.redis.zrem(timeline_key, jobid)
+            if room.get(queue_name, 1) <= 0:
+                # redis-py 2 and 3 take zadd()'s arguments differently.
+                self.redis.execute_command(
+                    'ZADD', self.held_key(queue_name), repr(score), jobid)
+                held += 1
+                continue
+            self.enqueue(jobid)
+            if queue_name in room:
+                room[queue_name] -= 1
+            scores.append(score)
+        return held
+
+    def drain(self, point_in_time, shard=0):
+        """Dispatch a shard's due jobs, page by page, while there's room.
 
-    def dispatch(self, after=None, csvfilename=None):
+        Returns the number of due jobs newly held back because their
+        queues were full.
+        """
+        held = 0
+        while True:
+            moved, skipped = self.dispatch_page(point_in_time, shard=shard)
+            held += skipped
+            if moved + skipped < self.dispatch_limit:
+                return held
+
+    def rate_limit(self, queue_name):
+        # Optional, so workers written before it keep working.
+        worker_rate_limit = getattr(self.worker, 'rate_limit', None)
+        return worker_rate_limit(queue_name) if worker_rate_limit else None
+
+    def consume_args(self, queue_name):
+        """The consume script's ARGV for a queue, up to the jobtags."""
+        rate = self.rate_limit(queue_name)
+        if rate is None:
+            return [self.timeout(queue_name), _ms(time.time()), '', '']
+        return [self.timeout(queue_name), _ms(time.time()), float(rate),
+                max(float(rate), 1.0)]
+
+    def high_water(self, queue_name):
+        # Optional, so workers written before it keep working.
+        worker_high_water = getattr(self.worker, 'high_water', None)
+        high_water = (worker_high_water(queue_name)
+                      if worker_high_water else None)
+        if high_water is None:
+            high_water = self.default_high_water
+        return high_water
+
+    def shard_high_waters(self, shard):
+        """High-water marks of a shard's queues, None for no mark."""
+        high_waters = OrderedDict()
+        for queue_shard, queue_name in self.shard_queues():
+            if queue_shard == shard or not self.cluster:
+                high_water = self.high_water(queue_name)
+                high_waters[queue_name] = (None if high_water is None
+                                           else int(high_water))
+        return high_waters
+
+    def high_waters(self, shard):
+        """High-water marks of a shard's queues that have them."""
+        return {queue_name: high_water for queue_name, high_water
+                in self.shard_high_waters(shard).items()
+                if high_water is not None}
+
+    def record_dispatched(self, scores):
+        if not scores:
+            return
+        now = time.time()
+        self.metrics.incr('dispatched', len(scores))
+        for score in scores:
+            self.metrics.observe('dispatch_lag', now - float(score))
+
+    def record_claimed(self, statuses):
+        """Count claimed jobs and time how long they waited in queue."""
+        if not statuses:
+            return
+        now = time.time()
+        self.metrics.incr('consumed', len(statuses))
+        for status in statuses:
+            event, _, timestamp = (_e(status) or '').partition(':')
+            if event == 'ENQ':
+                self.metrics.observe('queue_wait', now - float(timestamp))
+
+    def dispatch(self, after=None, csvfilename=None, shard=None):
+        """Dispatch due jobs until halted.
+
+        Dispatches one timeline shard if given, otherwise all of them.
+        """
+        shards = range(self.shards) if shard is None else [shard]
         if csvfilename:
             self.load_csv(csvfilename)
         if after is not None:
             point_in_time = after
         else:
             point_in_time = self.point_in_time()
-        point_in_time = int(point_in_time)
+        point_in_time = float(point_in_time)
+        checkpointed_at = None
+        if self.listen:
+            self.listen_for_control()
         while True:
-            outstanding = self.redis.zrangebyscore(
-                self.timeline_key, 0, point_in_time)
-            for jobid in outstanding:
-                self.redis.zrem(self.timeline_key, jobid)
-                self.enqueue(jobid)
-            time.sleep(.01)
-            point_in_time = int(time.time())
-            with open('%s.0' % self.timefile, 'w') as timefile:
-                timefile.write(str(point_in_time))
-            os.rename('%s.0' % self.timefile, self.timefile)
-            if self.is_halted():
+            # Drain any backlog in bounded chunks so no single call
+            # holds up Redis for long.
+            for shard in shards:
+                self.drain(point_in_time, shard=shard)
+            halted = self.is_halted()
+            if (halted or checkpointed_at is None or
+                    time.time() - checkpointed_at >= self.checkpoint_interval):
+                self.checkpoint.write(point_in_time)
+                checkpointed_at = time.time()
+            self.metrics.maybe_export()
+            if halted:
                 self.log.info("stopping on command")
                 break
+            if self.prefetch:
+                self.release_prefetched(point_in_time, shards=shards)
+            else:
+                self.sleep_until_due(shards=shards)
+            point_in_time = time.time()
+
+    def sleep_until_due(self, shards=None):
+        """Block until the earliest job on the timeline is due.
 
-    def remove_from_queue(self, jobid):
-        return self.redis.lrem(self.queue_for(jobid), 0, jobid)
+        Wakes early when an earlier job is added to the timeline and
+        never sleeps longer than `max_sleep`, so HALT is still noticed.
+        Jobs held back for full queues aren't on the timeline, and are
+        left to the next `max_sleep` poll.
+        """
+        if shards is None:
+            shards = range(self.shards)
+        timeout = self.max_sleep
+        wakeup_keys = []
+        for shard in shards:
+            keys = self.shard_keys(shard)
+            wakeup_keys.append(keys.wakeup_key)
+            earliest = self.redis.zrange(keys.timeline_key, 0, 0,
+                                         withscores=True)
+            if earliest:
+                timeout = min(timeout, earliest[0][1] - time.time())
+        if timeout > 0:
+            self.wait_for_wakeup(wakeup_keys, timeout)
+
+    def wait_for_wakeup(self, wakeup_keys, timeout):
+        """Block on the wakeup lists for up to `timeout` seconds.
+
+        Returns True if a token was taken off one of them.
+        """
+        if self.cluster and len(wakeup_keys) > 1:
+            # Can't block on keys in different slots. Run a dispatcher
+            # per shard to be woken early.
+            time.sleep(timeout)
+            return False
+        if not self.fractional_timeouts():
+            # Block for the whole seconds and leave the rest to the next
+            # call, so as not to wake after the job is due.
+            if timeout < 1:
+                time.sleep(timeout)
+                return False
+            return self.redis.brpop(wakeup_keys, int(timeout)) is not None
+        # Round up so as not to wake before the job is due. A zero
+        # timeout would block forever.
+        timeout = math.ceil(timeout * 1000) / 1000.0
+        return self.redis.brpop(wakeup_keys,
+                                "%.3f" % max(timeout, .001)) is not None
+
+    def fractional_timeouts(self):
+        """Whether the server takes fractional BRPOP timeouts (6.0+)."""
+        if self._fractional_timeouts is None:
+            version = _e(self.redis.info('server')['redis_version'])
+            self._fractional_timeouts = int(version.split('.')[0]) >= 6
+        return self._fractional_timeouts
+
+    def release_prefetched(self, point_in_time, shards=None):
+        """Read the next `prefetch` seconds of the timeline ahead and
+        release each job into its queue as it falls due.
+
+        Jobs due after `point_in_time`, which was last drained, are read
+        into a heap. How far ahead has been read is left in Redis, so
+        jobs set inside that window wake this to return and be read
+        again. Jobs moved or removed meanwhile are left alone when
+        released. Returns after `max_sleep` seconds at most.
+        """
+        if shards is None:
+            shards = range(self.shards)
+        now = time.time()
+        deadline = now + self.max_sleep
+        expires = int((self.max_sleep + 1) * 1000)
+        heap = []
+        wakeup_keys = []
+        for shard in shards:
+            keys = self.shard_keys(shard)
+            wakeup_keys.append(keys.wakeup_key)
+            horizon = now + self.prefetch
+            self.redis.set(keys.wakeup_key + '-horizon', _ms(horizon),
+                           px=expires)
+            entries = self.redis.zrangebyscore(
+                keys.timeline_key, '(%r' % float(point_in_time), horizon,
+                start=0, num=self.dispatch_limit, withscores=True)
+            if len(entries) == self.dispatch_limit:
+                # There's more in the window than was read.
+                deadline = min(deadline, entries[-1][1])
+            heap.extend((score, shard, _e(jobid))
+                        for jobid, score in entries)
+        heapq.heapify(heap)
+        while True:
+            until = min(heap[0][0], deadline) if heap else deadline
+            wait = until - time.time()
+            if wait > WAKEUP_MARGIN:
+                if self.wait_for_wakeup(wakeup_keys, wait - WAKEUP_MARGIN):
+                    return
+                continue
+            if wait > 0:
+                time.sleep(wait)
+            if not heap or heap[0][0] > deadline:
+                return
+            now = time.time()
+            due = {}
+            while heap and heap[0][0] <= now:
+                score, shard, jobid = heapq.heappop(heap)
+                due.setdefault(shard, []).append((jobid, score))
+            for shard, entries in sorted(due.items()):
+                self.release(entries, shard=shard)
+
+    def release(self, entries, shard=0):
+        """Move prefetched (jobid, score) pairs from timeline to queues.
+
+        Only jobs still on the timeline at the same score are moved.
+        Returns the number of jobs moved.
+        """
+        args = [_ms(time.time()), len(entries)]
+        for jobid, score in entries:
+            args += [jobid, repr(float(score)), self.queue_for(jobid)]
+        for queue_name, high_water in self.high_waters(shard).items():
+            args += [queue_name, high_water]
+        scores, _ = self.release_script(keys=self.shard_keys(shard),
+                                        args=args)
+        self.record_dispatched(scores)
+        if self.observers:
+            self.notify('on_dispatch_batch', shard, len(scores),
+                        time.time())
+        return len(scores)
+
+    def remove_from_queue(self, jobid, client=None):
+        return (client or self.redis).lrem(self.queue_for(jobid), 0, jobid)
 
     def queue_names(self):
-        return ["%s-%s" % (self.prefix, queue_name)
+        return [queue_name for _, queue_name in self.shard_queues()]
+
+    def shard_queues(self):
+        """(shard, queue name) pairs for every queue we consume.
+
+        In cluster mode each shard has its own copy of each queue.
+        """
+        return [(shard, "%s-%s" % (self.keyspace(shard), queue_name))
+                for shard in self.data_shards()
                 for queue_name in self.worker.queue_names()]
 
+    def timeout(self, queue_name):
+        timeout = self.worker.timeout(queue_name)
+        if timeout is None:
+            timeout = self.default_timeout
+        return timeout
+
     def consumer_generator(self):
+        """Yield lists of claimed (jobid, jobtag) pairs, one per queue.
+
+        Claims up to `batch_size` jobs at a time. Lists may be empty.
+        """
         while True:
-            for queue_name in self.queue_names():
-                jobtag = '%030x' % random.randrange(16**30)
-                timeout = self.worker.timeout(queue_name)
-                if timeout is None:
-                    timeout = self.default_timeout
-                args = [queue_name, timeout, int(time.time()), jobtag]
-                yield (_e(self.consume_script(args=args)), jobtag)
+            claimed = False
+            paused = self.paused_queues()
+            for shard, queue_name in self.shard_queues():
+                if queue_name in paused:
+                    continue
+                pairs = self.consume(shard, queue_name)
+                claimed = claimed or bool(pairs)
+                yield pairs
+            if not claimed and self.block_timeout > 0:
+                # Nothing on any queue. Rather than spin, wait a while.
+                yield self.block_for_work()
+
+    def consume(self, shard, queue_name):
+        """Claim up to `batch_size` jobs from a queue.
+
+        Returns a list of claimed (jobid, jobtag) pairs, maybe empty.
+        """
+        jobtags = [_jobtag() for _ in range(self.batch_size)]
+        keys = list(self.shard_keys(shard)) + [queue_name]
+        args = self.consume_args(queue_name) + jobtags
+        jobids, statuses = self.consume_script(keys=keys, args=args)
+        jobids = [_e(jobid) for jobid in jobids]
+        self.record_claimed(statuses)
+        pairs = list(zip(jobids, jobtags))
+        if pairs and self.observers:
+            self.notify('on_claim', pairs)
+        return pairs
+
+    def ready_key(self, queue_name):
+        return "%s-ready" % queue_name
+
+    def held_key(self, queue_name):
+        """Due jobs held back for a full queue, by timeline score."""
+        return "%s-held" % queue_name
+
+    def block_for_work(self):
+        """Block on all our queues at once and claim from the first to
+        have work.
+
+        Blocks on the queues' ready lists, which get a token for each
+        job queued, and claims like consume(). Returns the claimed
+        pairs, an empty list if `block_timeout` runs out first or
+        another worker claimed the work.
+        """
+        shards = self.blocking_shards()
+        if not shards:
+            # Every queue is rate limited or paused.
+            time.sleep(self.block_timeout)
+            return []
+        ready_keys = OrderedDict((self.ready_key(queue_name), queue_name)
+                                 for queue_name in shards)
+        popped = self.redis.brpop(list(ready_keys), self.block_timeout)
+        if popped is None:
+            return []
+        queue_name = ready_keys[_e(popped[0])]
+        return self.consume(shards[queue_name], queue_name)
+
+    def blocking_shards(self):
+        """The queues to block on, mapped to their shards.
+
+        In cluster mode that's one shard's queues, a different shard
+        each time, since BRPOP can't span slots. Rate limited queues
+        are left out, since BRPOP would get around their limits, and so
+        are paused queues.
+        """
+        paused = self.paused_queues()
+        shard_queues = [(shard, queue_name) for shard, queue_name
+                        in self.shard_queues()
+                        if queue_name not in paused and
+                        self.rate_limit(queue_name) is None]
+        if self.cluster:
+            shard = next(self._blocking_shard) % self.shards
+            shard_queues = [(s, q) for s, q in shard_queues if s == shard]
+        return OrderedDict((queue_name, shard)
+                           for shard, queue_name in shard_queues)
 
     def is_working_key(self, jobid):
         return "%s-%s" % (self.queue_for(jobid), _e(jobid))
 
-    def recycle(self, jobid, jobtag):
-        working_key = self.is_working_key(jobid)
-        if _e(self.redis.get(working_key)) == _e(jobtag):
-            return self.redis.delete(working_key)
-        else:
-            return False
+    def recycle(self, jobid, jobtag, client=None):
+        return self.recycle_script(
+            keys=list(self.keys_for(jobid)) + [self.is_working_key(jobid)],
+            args=[jobtag], client=client)
 
     def is_working(self, jobid):
         return self.redis.exists(self.is_working_key(jobid))
 
-    def work(self):
-        for jobid, jobtag in self.consumer:
-            if jobid:
-                try:
-                    backoff = None
-                    try:
-                        backoff = self.worker.work(jobid)
-                    except StopWork:
-                        self.set_schedule(jobid, 'STOP')
-                    except UnsetJob:
-                        self.unset(jobid)
-                        self.recycle(jobid, jobtag)
-                        continue
-                    self.reschedule(jobid, jobtag, backoff=backoff)
-                except Exception as ex:
-                    self.log.exception(ex)
-                    self.set_status(jobid, 'DIE')
-                    self.recycle(jobid, jobtag)
+    def work(self, concurrency=None, executor=None):
+        """Work jobs until halted, `concurrency` at a time.
+
+        With concurrency above 1, `executor` says whether to run that
+        many worker threads or to supervise that many forked worker
+        processes.
+        """
+        concurrency = int(concurrency or self.concurrency)
+        executor = executor or self.executor
+        if self.listen:
+            self.listen_for_control()
+        if concurrency <= 1:
+            self.work_loop(self.consumer)
+        elif executor == 'thread':
+            self.work_threads(concurrency)
+        elif executor == 'process':
+            self.work_processes(concurrency)
+        else:
+            raise ValueError("Unknown executor %r" % executor)
+
+    def work_loop(self, consumer):
+        for claimed in consumer:
+            if claimed:
+                self.work_batch(claimed)
+            self.metrics.maybe_export()
             if self.is_halted():
                 self.log.info("stopping on command")
                 break
 
-    def get_statuses(self, before=None):
+    def work_threads(self, concurrency):
+        # Each thread has its own consumer. They share a connection pool.
+        threads = [threading.Thread(target=self._work_thread)
+                   for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def _work_thread(self):
+        """Run a worker loop until halted, starting over if it dies."""
+        while True:
+            try:
+                return self.work_loop(self.consumer_generator())
+            except Exception as ex:
+                self.log.exception(ex)
+            if self.stop_event is not None and self.stop_event.is_set():
+                return
+            self.log.warn("worker thread restarting")
+            time.sleep(1)
+
+    def work_processes(self, concurrency):
+        """Fork `concurrency` workers and keep them going until halted.
+
+        Workers stop by themselves on HALT. If the stop event is set
+        instead, they're sent SIGTERM and finish their current jobs.
+        """
+        children = set(self._fork_worker() for _ in range(concurrency))
+        stopping = False
+        while children:
+            time.sleep(.5)
+            for pid in list(children):
+                done, status = os.waitpid(pid, os.WNOHANG)
+                if done:
+                    children.discard(pid)
+                    if status:
+                        self.log.warn("worker %s exited %s", pid, status)
+            if stopping:
+                continue
+            if self.is_halted():
+                stopping = True
+                if (self.stop_event is not None and
+                        self.stop_event.is_set() and
+                        not self._halted_by_control):
+                    for pid in children:
+                        os.kill(pid, signal.SIGTERM)
+            else:
+                while len(children) < concurrency:
+                    children.add(self._fork_worker())
+
+    def _fork_worker(self):
+        pid = os.fork()
+        if pid:
+            return pid
+        status = 1
+        try:
+            # The forking thread is this process's main thread now.
+            stop_event = threading.Event()
+            signal.set_wakeup_fd(-1)
+            for signum in (signal.SIGTERM, signal.SIGINT,
+                           signal.SIGHUP, signal.SIGQUIT):
+                signal.signal(signum, lambda signum, frame: stop_event.set())
+            self.stop_event = stop_event
+            # The listener thread didn't come with us.
+            self._control_thread = None
+            self._halted_by_control = False
+            if self.listen:
+                self.listen_for_control()
+            self.work_loop(self.consumer_generator())
+            status = 0
+        except Exception as ex:
+            self.log.exception(ex)
+        finally:
+            os._exit(status)
+
+    def work_batch(self, claimed):
+        """Work each claimed job, then wrap them all up in one pipeline.
+
+        A second pipeline puts RRULE jobs back on the timeline.
+        """
+        worked = [(jobid, jobtag) + self._work_one(jobid)
+                  for jobid, jobtag in claimed]
+        pipe = self.pipeline()
+        finished = []
+        try:
+            for jobid, jobtag, outcome, backoff in worked:
+                if self._wrap_up(jobid, jobtag, outcome, backoff, pipe):
+                    finished.append((len(pipe) - 1, jobid))
+            results = pipe.execute()
+        except Exception as ex:
+            self.log.exception(ex)
+            # Jobs that were wrapped up before it failed aren't ours to
+            # recycle any more, and are left alone.
+            for jobid, jobtag in claimed:
+                if self.recycle(jobid, jobtag):
+                    self.set_status(jobid, 'DIE')
+            return
+        self._refill(finished, results, pipe)
+
+    def _refill(self, finished, results, pipe):
+        """Schedule the next runs of rescheduled RRULE jobs.
+
+        `finished` pairs the jobids with the positions of their results.
+        """
+        refills = []
+        try:
+            for position, jobid in finished:
+                if self.observers:
+                    self.notify('on_reschedule', jobid, results[position])
+                if results[position] is not None:
+                    refills.append(jobid)
+                    self.schedule(jobid, results[position], client=pipe)
+            if len(pipe):
+                pipe.execute()
+        except Exception as ex:
+            self.log.exception(ex)
+            for jobid in refills:
+                self.set_status(jobid, 'DIE')
+
+    def _work_one(self, jobid):
+        """Work a job. Returns its outcome and any backoff it asked for.
+
+        The outcome is completed, stopped, unset or died.
+        """
+        backoff = None
+        if self.observers:
+            self.notify('on_work_start', jobid)
+        started = time.time()
+        try:
+            backoff = self.worker.work(jobid)
+            outcome = 'completed'
+        except StopWork:
+            outcome = 'stopped'
+        except UnsetJob:
+            outcome = 'unset'
+        except Exception as ex:
+            self.log.exception(ex)
+            outcome = 'died'
+        duration = time.time() - started
+        self.metrics.incr(outcome)
+        self.metrics.observe('work_duration', duration)
+        if self.observers:
+            self.notify('on_work_end', jobid, duration, outcome)
+        return outcome, backoff
+
+    def _wrap_up(self, jobid, jobtag, outcome, backoff, client):
+        """Queue what a worked job's outcome calls for on `client`.
+
+        Returns True if that ends with rescheduling the job.
+        """
+        if outcome == 'stopped':
+            self.set_schedule(jobid, 'STOP', client=client)
+        elif outcome == 'unset':
+            self.unset(jobid, client=client)
+        elif outcome == 'died':
+            self.set_status(jobid, 'DIE', client=client)
+        if outcome in ('unset', 'died'):
+            self.recycle(jobid, jobtag, client=client)
+            return False
+        self.reschedule(jobid, jobtag, backoff=backoff, client=client)
+        return True
+
+    def get_statuses(self, before=None, event=None):
+        """Yield (jobid, event, timestamp) for statuses set by `before`.
+
+        Pages through the status index oldest first, `scan_count` at a
+        time, optionally only for jobs whose last status was `event`.
+        """
         if before is None:
             before = time.time()
-        before = int(before)
-        all_statuses = self.redis.hgetall(self.statuses_key)
-        for jobid, status in all_statuses.items():
-            event, timestamp = _e(status).split(':')
-            timestamp = int(timestamp)
-            if timestamp <= before:
-                yield _e(jobid), event, timestamp
+        before = float(before)
+        shards = self.data_shards()
+        if len(shards) == 1:
+            return self._shard_statuses(shards[0], before, event)
+        # Merge the shards' statuses, still oldest first.
+        merged = heapq.merge(*[
+            ((timestamp, jobid, status_event) for jobid, status_event,
+             timestamp in self._shard_statuses(shard, before, event))
+            for shard in shards])
+        return ((jobid, status_event, timestamp)
+                for timestamp, jobid, status_event in merged)
+
+    def _shard_statuses(self, shard, before, event):
+        keys = self.shard_keys(shard)
+        index_key = keys.status_index_key
+        if event and self.index_events:
+            index_key = '%s-%s' % (index_key, event)
+        # Page by score rather than offset so that statuses changing
+        # underneath us don't shift the pages.
+        low, seen = 0, 0
+        while True:
+            page = self.redis.zrangebyscore(
+                index_key, low, before, start=seen, num=self.scan_count,
+                withscores=True)
+            if not page:
+                break
+            jobids = [jobid for jobid, _ in page]
+            statuses = self.redis.hmget(keys.statuses_key, jobids)
+            for jobid, status in zip(jobids, statuses):
+                if status is None:
+                    continue  # unset since we read the index
+                status_event, timestamp = _e(status).split(':')
+                timestamp = _ms(timestamp)
+                if event and status_event != event:
+                    continue
+                if timestamp <= before:
+                    yield _e(jobid), status_event, timestamp
+            last = page[-1][1]
+            at_last = len([score for _, score in page if score == last])
+            seen = seen + at_last if last == low else at_last
+            low = last
+
+    def reindex_statuses(self):
+        """Index statuses set before Redbike kept a status index.
+
+        Returns the number of statuses indexed.
+        """
+        count = 0
+        pipe = self.pipeline()
+        for shard in self.data_shards():
+            statuses = self.redis.hscan_iter(
+                self.shard_keys(shard).statuses_key, count=self.scan_count)
+            for jobid, status in statuses:
+                event, timestamp = _e(status).split(':')
+                self.set_status(jobid, event, timestamp=timestamp,
+                                client=pipe)
+                count += 1
+                if len(pipe) >= self.scan_count:
+                    pipe.execute()
+        pipe.execute()
+        return count
 
     def get_schedules(self):
-        return self.redis.hgetall(self.schedules_key).items()
+        """Yield (jobid, schedule) pairs, streamed like get_statuses()."""
+        for shard in self.data_shards():
+            schedules = self.redis.hscan_iter(
+                self.shard_keys(shard).schedules_key, count=self.scan_count)
+            for jobid, schedule in schedules:
+                yield _e(jobid), _e(schedule)
+
+    def stats(self):
+        """Sample the length of each queue and the timeline backlog.
 
-    def flush(self):
-        keys = self.redis.keys("%s-*" % self.prefix)
-        if keys:
-            return self.redis.delete(*keys)
-        return 0
+        `due` counts timeline jobs whose time has come, `scheduled`
+        every job on the timeline, and `held` due jobs held back for
+        full queues.
+        """
+        now = time.time()
+        queue_names = list(OrderedDict.fromkeys(self.queue_names()))
+        timeline_keys = [self.shard_keys(shard).timeline_key
+                         for shard in range(self.shards)]
+        pipe = self.redis.pipeline(transaction=False)
+        for queue_name in queue_names:
+            pipe.llen(queue_name)
+        for queue_name in queue_names:
+            pipe.zcard(self.held_key(queue_name))
+        for timeline_key in timeline_keys:
+            pipe.zcount(timeline_key, 0, now)
+            pipe.zcard(timeline_key)
+        results = pipe.execute()
+        queue_lengths = results[:len(queue_names)]
+        held = sum(results[len(queue_names):2 * len(queue_names)])
+        timeline_counts = results[2 * len(queue_names):]
+        return {"queues": dict(zip(queue_names, queue_lengths)),
+                "timeline": {"due": sum(timeline_counts[0::2]),
+                             "scheduled": sum(timeline_counts[1::2]),
+                             "held": held}}
+
+    def flush(self, dry_run=False, progress=None):
+        """Delete all of Redbike's keys, `scan_count` at a time.
+
+        Keys are found with SCAN and freed with UNLINK, so a big flush
+        doesn't block Redis. With `dry_run` nothing is deleted. If
+        given, `progress` is called with the count of keys so far after
+        each batch. Returns the count of keys found.
+        """
+        patterns = ["%s-*" % self.prefix]
+        if self.cluster:
+            patterns.append("{%s-*" % self.prefix)
+        found = 0
+        for pattern in patterns:
+            keys = self.redis.scan_iter(match=pattern, count=self.scan_count)
+            while True:
+                batch = list(islice(keys, self.scan_count))
+                if not batch:
+                    break
+                found += len(batch)
+                if not dry_run:
+                    self.unlink(*batch)
+                if progress is not None:
+                    progress(found)
+        return found
+
+    def unlink(self, *keys):
+        if hasattr(self.redis, 'unlink'):
+            return self.redis.unlink(*keys)
+        return self.redis.execute_command('UNLINK', *keys)  # redis-py < 3
 
     def tell(self, jobid):
-        return {"status": _e(self.redis.hget(self.statuses_key, jobid)),
-                "schedule": _e(self.redis.hget(self.schedules_key, jobid)),
-                "next_run": self.redis.zscore(self.timeline_key, jobid),
+        keys = self.keys_for(jobid)
+        next_run = self.redis.zscore(keys.timeline_key, jobid)
+        if next_run is None:
+            next_run = self.redis.zscore(
+                self.held_key(self.queue_for(jobid)), jobid)
+        return {"status": _e(self.redis.hget(keys.statuses_key, jobid)),
+                "schedule": _e(self.redis.hget(keys.schedules_key, jobid)),
+                "next_run": next_run,
+                "upcoming": [_ms(run) for run in self.redis.lrange(
+                    self.upcoming_key(jobid), 0, -1)],
                 "working": self.is_working(jobid)}
 
 
+class _Unpipelined(object):
+    """Runs commands as they're queued, keeping their results for
+    execute(), like a pipeline that isn't one."""
+
+    def __init__(self, client):
+        self.client = client
+        self.results = []
+
+    def __len__(self):
+        return len(self.results)
+
+    def __getattr__(self, name):
+        command = getattr(self.client, name)
+        if name == 'script_load':  # a script loading itself to retry
+            return command
+
+        def run(*args, **kwargs):
+            result = command(*args, **kwargs)
+            self.results.append(result)
+            return result
+        return run
+
+    def execute(self):
+        results, self.results = self.results, []
+        return results
+
+
+def _bool(value):  # config values come in as strings
+    if hasattr(value, 'lower'):
+        return value.lower() in ('1', 'yes', 'true', 'on')
+    return bool(value)
+
+
+def _ms(timestamp):
+    """A timestamp to the millisecond, as an int if it's a whole second."""
+    timestamp = round(float(_e(timestamp)), 3)
+    return int(timestamp) if timestamp.is_integer() else timestamp
+
+
+def _timestamp(dt):
+    return calendar.timegm(dt.timetuple()) + dt.microsecond / 1e6
+
+
+def _lua(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return repr(value)
+
+
+def _jobtag():
+    return '%030x' % random.randrange(16**30)
+
+
+def _function(method):
+    return getattr(method, '__func__', method)  # unbound on py2
+
+
 class RoundRobin(object):
 
     def __init__(self, initstring):
@@ -295,8 +1673,30 @@ class RoundRobin(object):
     def queue_names(self):
         return [self.name_queue(x) for x in self.initstring.split(':')]
 
+    @property
+    def queue_for_lua(self):
+        """Lua version of queue_for() so dispatch can route server-side.
+
+        Subclasses that change how queues are named must provide their
+        own (or None to route from the client).
+        """
+        cls = type(self)
+        if (_function(cls.queue_for) is _function(RoundRobin.queue_for) and
+                _function(cls.name_queue) is
+                _function(RoundRobin.name_queue)):
+            return ROUND_ROBIN_QUEUE_FOR_LUA
+
     def work(self, jobid):
         raise NotImplemented  # pragma: no cover
 
     def timeout(self, queue_name):
         return None
+
+    def high_water(self, queue_name):
+        return None
+
+    def rate_limit(self, queue_name):
+        return None
+
+    def spread(self, jobid):
+        return None
@@ -0,0 +1,28 @@
+import asyncio
+
+from redbike import StopWork
+from tests.test_redbike import TestWorker
+
+
+class AsyncTestWorker(TestWorker):
+
+    async def work(self, jobid):
+        await self.bike.redis.hincrby('biketest-results', jobid, amount=1)
+        await asyncio.sleep(.2)
+        if jobid.startswith('stopper:'):
+            raise StopWork("Stop this job.")
+
+
+class AsyncClusterWorker(TestWorker):
+
+    async def work(self, jobid):
+        await self.bike.redis.hincrby('clustertest-results', jobid, amount=1)
+
+
+async def work_all(bike):
+    """Claim and work a batch from each queue."""
+    consumer = bike.consumer_generator()
+    for _ in bike.queue_names():
+        claimed = await consumer.__anext__()
+        if claimed:
+            await bike.work_batch(claimed)
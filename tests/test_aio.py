@@ -0,0 +1,77 @@
+import time
+from unittest import TestCase, skipIf
+
+from redbike import Redbike
+from redbike.schedule import _e
+from tests.test_redbike import TestWorker
+
+try:
+    import asyncio
+    from redbike.aio import AsyncRedbike, aioredis
+    from tests.aio_worker import AsyncTestWorker
+except SyntaxError:  # no async def before Python 3.5
+    aioredis = None
+
+
+@skipIf(aioredis is None, "needs redis.asyncio")
+class AsyncRedbikeTests(TestCase):
+
+    def setUp(self):
+        self.bike = AsyncRedbike(AsyncTestWorker('A:Z'), prefix='biketest',
+                                 concurrency=5)
+        self.bike.worker.bike = self.bike
+        Redbike(TestWorker('A:Z'), prefix='biketest').flush()
+        self.run_async(self.bike.control("HALT"))
+
+    def tearDown(self):
+        self.run_async(self.bike.close())
+
+    def run_async(self, coroutine):
+        return asyncio.get_event_loop().run_until_complete(coroutine)
+
+    def test_set_and_work(self):
+        for i in range(5):
+            self.run_async(self.bike.set('job%s:A' % i, 'CONTINUE'))
+        self.run_async(self.bike.set('stopper:A', 'CONTINUE'))
+        self.run_async(self.bike.set('rrule:A', 'AT:%s' % int(time.time())))
+        tell = self.run_async(self.bike.tell('rrule:A'))
+        #B: The async client sets jobs with the same keys and scripts.
+        self.assertTrue(tell['status'].startswith('TML:'))
+        self.assertEqual(tell['schedule'], 'STOP')
+        #B: The async worker works up to concurrency jobs at once.
+        started = time.time()
+        self.run_async(self.bike.work())
+        self.assertTrue(time.time() - started < 1)
+        results = self.run_async(self.bike.redis.hgetall('biketest-results'))
+        self.assertEqual(len(results), 5)
+        #B: Async workers reschedule jobs just like sync workers.
+        queue = self.run_async(self.bike.redis.lrange('biketest-work-A',
+                                                      0, -1))
+        self.assertEqual(len(queue), 6)
+        self.run_async(self.bike.work(concurrency=1))
+        tell = self.run_async(self.bike.tell('stopper:A'))
+        self.assertEqual(tell['schedule'], 'STOP')
+        self.assertTrue(tell['status'].startswith('STP:'))
+        self.assertEqual(_e(self.run_async(
+            self.bike.redis.hget('biketest-results', 'stopper:A'))), '1')
+
+    def test_control_listener(self):
+        self.run_async(self.bike.clear_control())
+        self.run_async(self.bike.listen_for_control())
+        #B: A listening async process doesn't check the control key.
+        self.run_async(self.bike.redis.set(self.bike.control_key, 'HALT'))
+        self.assertFalse(self.run_async(self.bike.is_halted()))
+        #B: A listening async process hears HALT and sets its stop event.
+        self.run_async(self.bike.control('HALT'))
+        for _ in range(20):
+            if self.run_async(self.bike.is_halted()):
+                break
+            self.run_async(asyncio.sleep(.1))
+        self.assertTrue(self.bike.stop_event.is_set())
+
+    def test_sync_only_methods(self):
+        #B: Methods with no async version raise rather than do nothing.
+        self.assertRaises(NotImplementedError, self.bike.set_many,
+                          [('job:A', 'NOW')])
+        self.assertRaises(NotImplementedError, self.bike.dispatch)
+        self.assertRaises(NotImplementedError, self.bike.flush)
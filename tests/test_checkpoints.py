@@ -0,0 +1,45 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import redis
+
+from redbike.checkpoints import FileCheckpoint, RedisCheckpoint
+
+
+class FileCheckpointTests(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.checkpoint = FileCheckpoint(os.path.join(self.dir, 'timefile'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_read_and_write(self):
+        #B: There's no point in time before one is written.
+        self.assertEqual(self.checkpoint.read(), None)
+        #B: The point in time written is read back to the millisecond.
+        self.checkpoint.write(1000.1234)
+        self.assertEqual(self.checkpoint.read(), 1000.123)
+        #B: Writing leaves no temporary file behind.
+        self.assertEqual(os.listdir(self.dir), ['timefile'])
+
+
+class RedisCheckpointTests(TestCase):
+
+    def setUp(self):
+        self.redis = redis.StrictRedis()
+        self.redis.delete('biketest-checkpoint')
+        self.checkpoint = RedisCheckpoint(self.redis, 'biketest-checkpoint')
+
+    def tearDown(self):
+        self.redis.delete('biketest-checkpoint')
+
+    def test_read_and_write(self):
+        #B: There's no point in time before one is written.
+        self.assertEqual(self.checkpoint.read(), None)
+        #B: The point in time written is read back to the millisecond.
+        self.checkpoint.write(1000.1234)
+        self.assertEqual(self.checkpoint.read(), 1000.123)
@@ -0,0 +1,119 @@
+"""Tests against a real Redis Cluster.
+
+Set REDBIKE_TEST_CLUSTER to the host:port of a cluster node (by default
+127.0.0.1:7000). Skipped when there's no cluster there, or redis-py is
+too old for cluster mode.
+"""
+
+import os
+import time
+import unittest
+
+import redis
+
+from redbike import Redbike, RoundRobin
+from redbike.schedule import _e  # for py3 compat
+
+try:
+    import asyncio
+    from redbike.aio import AsyncRedbike, aioredis
+    from tests.aio_worker import AsyncClusterWorker, work_all
+except SyntaxError:  # no async def before Python 3.5
+    aioredis = None
+
+
+def cluster_config():
+    if not hasattr(redis, 'RedisCluster'):
+        return None
+    host, port = os.environ.get('REDBIKE_TEST_CLUSTER',
+                                '127.0.0.1:7000').rsplit(':', 1)
+    config = {'host': host, 'port': int(port)}
+    try:
+        redis.RedisCluster(**config).ping()
+    except Exception:
+        return None
+    return config
+
+
+CLUSTER_CONFIG = cluster_config()
+
+
+class ClusterWorker(RoundRobin):
+
+    def work(self, jobid):
+        self.bike.redis.hincrby('clustertest-results', jobid, amount=1)
+
+
+@unittest.skipIf(CLUSTER_CONFIG is None, "no Redis Cluster to test against")
+class ClusterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.bike = Redbike(ClusterWorker('A:Z'), prefix='clustertest',
+                            redis_config=CLUSTER_CONFIG, cluster=True,
+                            shards=3, block_timeout=0, lookahead=1)
+        self.bike.worker.bike = self.bike
+        self.r = self.bike.redis
+        self.bike.flush()
+        self.r.delete('clustertest-results')
+
+    def tearDown(self):
+        self.bike.flush()
+        self.r.delete('clustertest-results')
+
+    def result(self, jobid):
+        return _e(self.r.hget('clustertest-results', jobid))
+
+    def work_all(self):
+        consumer = self.bike.consumer_generator()
+        for _ in self.bike.queue_names():
+            claimed = next(consumer)
+            if claimed:
+                self.bike.work_batch(claimed)
+
+    def test_set_many_and_work_batch(self):
+        jobids = ['job%s:%s' % (i, 'AZ'[i % 2]) for i in range(9)]
+        rrule = "RRULE:FREQ=SECONDLY"
+        #B: Jobs can be set in bulk in cluster mode.
+        self.assertEqual(
+            self.bike.set_many([(jobid, 'NOW') for jobid in jobids] +
+                               [('rrule:A', rrule)]), (10, 0))
+        for shard in range(self.bike.shards):
+            self.bike.dispatch_due(time.time() + 5, shard=shard)
+        self.bike.batch_size = len(jobids) + 1
+        #B: Batches of jobs are worked and wrapped up in cluster mode.
+        self.work_all()
+        for jobid in jobids + ['rrule:A']:
+            self.assertEqual(self.result(jobid), '1')
+        for jobid in jobids:
+            self.assertEqual(self.bike.tell(jobid)['status'][:3], 'STP')
+        #B: RRULE jobs are put back on the timeline in cluster mode.
+        self.assertTrue(self.bike.tell('rrule:A')['next_run'] > 0)
+        self.assertFalse(self.bike.is_working('rrule:A'))
+        #B: Statuses can be reindexed in cluster mode.
+        self.bike.reindex_statuses()
+        self.assertEqual(len(list(self.bike.get_statuses(event='STP'))),
+                         len(jobids))
+
+
+@unittest.skipIf(CLUSTER_CONFIG is None or aioredis is None,
+                 "no Redis Cluster or redis.asyncio to test against")
+class AsyncClusterTests(ClusterTests):
+
+    def setUp(self):
+        ClusterTests.setUp(self)
+        self.async_bike = AsyncRedbike(
+            AsyncClusterWorker('A:Z'), prefix='clustertest',
+            redis_config=CLUSTER_CONFIG, cluster=True, shards=3,
+            block_timeout=0, lookahead=1)
+        self.async_bike.worker.bike = self.async_bike
+
+    def tearDown(self):
+        self.run_async(self.async_bike.close())
+        ClusterTests.tearDown(self)
+
+    def run_async(self, coroutine):
+        return asyncio.get_event_loop().run_until_complete(coroutine)
+
+    def work_all(self):
+        self.async_bike.batch_size = self.bike.batch_size
+        self.run_async(work_all(self.async_bike))
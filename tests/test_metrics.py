@@ -0,0 +1,36 @@
+from unittest import TestCase
+
+from redbike.metrics import Histogram, Metrics
+
+
+class HistogramTests(TestCase):
+
+    def test_percentiles(self):
+        histogram = Histogram(buckets=(1, 2, 5))
+        for value in (.5, .5, 1.5, 4, 10):
+            histogram.observe(value)
+        #B: Histograms count values into buckets by upper bound.
+        self.assertEqual(histogram.counts, [2, 1, 1, 1])
+        self.assertEqual(histogram.sum, 16.5)
+        #B: Percentiles are the upper bound of the bucket they fall in.
+        self.assertEqual(histogram.percentile(50), 2)
+        self.assertEqual(histogram.percentile(99), float('inf'))
+        self.assertEqual(Histogram().percentile(50), None)
+
+
+class MetricsTests(TestCase):
+
+    def test_export(self):
+        exported = []
+        metrics = Metrics(exporter=exported.append, interval=60)
+        metrics.incr('dispatched', 3)
+        metrics.observe('work_duration', .2)
+        #B: Metrics aren't exported before the interval is up.
+        metrics.maybe_export()
+        self.assertEqual(exported, [])
+        #B: Exporters get a snapshot of counters and histograms.
+        metrics.interval = 0
+        metrics.maybe_export()
+        self.assertEqual(exported[0]['counters'], {'dispatched': 3})
+        self.assertEqual(exported[0]['histograms']['work_duration']['count'],
+                         1)
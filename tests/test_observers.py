@@ -0,0 +1,29 @@
+from unittest import TestCase
+
+from flexmock import flexmock
+
+from redbike.observers import ProfilingObserver, SlowJobLogger
+
+
+class ObserverTests(TestCase):
+
+    def test_slow_job_logger(self):
+        log = flexmock()
+        log.should_receive('warning').once()
+        logger = SlowJobLogger(threshold=1, log=log)
+        #B: Only jobs slower than the threshold are logged.
+        logger.on_work_end('quick:A', .5, 'completed')
+        logger.on_work_end('slow:A', 1.5, 'completed')
+
+    def test_profiling_observer(self):
+        log = flexmock()
+        log.should_receive('info').once()
+        #B: Sampled jobs are profiled and the profile logged.
+        profiler = ProfilingObserver(sample_rate=1, log=log)
+        profiler.on_work_start('job:A')
+        sum(range(1000))
+        profiler.on_work_end('job:A', .1, 'completed')
+        #B: Jobs that aren't sampled aren't profiled.
+        profiler.sample_rate = 0
+        profiler.on_work_start('job:A')
+        profiler.on_work_end('job:A', .1, 'completed')
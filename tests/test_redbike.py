@@ -1,12 +1,15 @@
+import calendar
 from datetime import datetime, timedelta
 import os
+import threading
 import time
 
 from unittest import TestCase
 
 from flexmock import flexmock
+import redis
 
-from redbike import Redbike, RoundRobin, StopWork, UnsetJob
+from redbike import Observer, Redbike, RoundRobin, StopWork, UnsetJob
 from redbike.schedule import _e  # for py3 compat
 
 
@@ -33,6 +36,22 @@ class TestWorker(RoundRobin):
             return default
 
 
+class MinimalWorker(object):
+    """Only what the README asks of a worker."""
+
+    def queue_for(self, jobid):
+        return 'work-%s' % _e(jobid).split(':')[-1]
+
+    def queue_names(self):
+        return ['work-A', 'work-Z']
+
+    def work(self, jobid):
+        pass
+
+    def timeout(self, queue_name):
+        return None
+
+
 class RedbikeTests(TestCase):
 
     def setUp(self):
@@ -72,12 +91,18 @@ class RedbikeTests(TestCase):
         self.bike.work()
         self.bike.work()
 
+    def claim(self):
+        for claimed in self.bike.consumer:
+            if claimed:
+                return claimed[0]
+
     def test_set_and_unset(self):
         #B: Setting a job populates the attendant data structures in Redis.
         self.assertEqual(self.bike.tell('job:A'),
                          {'status': None,
                           'next_run': None,
                           'schedule': None,
+                          'upcoming': [],
                           'working': False})
         self.bike.set('job:A', 'AT:%s' % int(time.time() + 2))
         tell = self.bike.tell('job:A')
@@ -89,6 +114,7 @@ class RedbikeTests(TestCase):
                          {'status': None,
                           'next_run': None,
                           'schedule': None,
+                          'upcoming': [],
                           'working': False})
         #B: Un-setting a job does remove it from the work queue.
         self.bike.set('job:A', 'CONTINUE')
@@ -101,6 +127,7 @@ class RedbikeTests(TestCase):
                          {'status': None,
                           'next_run': None,
                           'schedule': None,
+                          'upcoming': [],
                           'working': False})
         self.assertEqual(self.queue(), [])
         #B: Setting a None schedule is just like unsetting.
@@ -109,6 +136,7 @@ class RedbikeTests(TestCase):
                          {'status': None,
                           'next_run': None,
                           'schedule': None,
+                          'upcoming': [],
                           'working': False})
         self.assertEqual(self.queue(), [])
 
@@ -171,6 +199,27 @@ class RedbikeTests(TestCase):
         self.assertEqual(self.queue(), [])
         self.assertEqual(self.timeline(), ['job:A'])
 
+    def test_rrule_lookahead(self):
+        self.bike.lookahead = 3
+        self.bike.set('job:A', self.gen_rrule())
+        tell = self.bike.tell('job:A')
+        #B: Setting an RRULE job stores the runs after the next one.
+        next_run = int(tell['next_run'])
+        self.assertEqual(tell['upcoming'], [next_run + 1, next_run + 2])
+        #B: Recurring jobs are rescheduled from their upcoming runs.
+        lookups = self.bike.rrules.hits + self.bike.rrules.misses
+        self.bike.dispatch(after=time.time() + 2)
+        jobid, jobtag = self.claim()
+        self.assertEqual(self.bike.reschedule(jobid, jobtag), None)
+        self.assertEqual(self.bike.rrules.hits + self.bike.rrules.misses,
+                         lookups)
+        tell = self.bike.tell('job:A')
+        self.assertTrue(tell['next_run'] > time.time())
+        self.assertTrue(len(tell['upcoming']) < 2)
+        #B: Changing a job's schedule drops its upcoming runs.
+        self.bike.set_schedule('job:A', 'CONTINUE')
+        self.assertEqual(self.bike.tell('job:A')['upcoming'], [])
+
     def test_bad_rrule(self):
         self.bike.set('job:A', "DTSTART:20131009T164510\nR:FREQ=Secondly")
         tell = self.bike.tell('job:A')
@@ -238,16 +287,568 @@ class RedbikeTests(TestCase):
         statuses = list(self.bike.get_statuses())
         self.assertEqual(len(statuses), 2)
 
+    def test_dispatch_in_chunks(self):
+        self.bike.dispatch_limit = 2
+        for i in range(5):
+            self.bike.set('job%s:A' % i, 'AT:%s' % int(time.time()))
+        #B: Dispatch moves at most dispatch_limit due jobs per call.
+        self.assertEqual(self.bike.dispatch_due(time.time()), 2)
+        self.assertEqual(len(self.queue()), 2)
+        #B: Dispatch drains a due backlog in chunks.
+        self.bike.dispatch()
+        self.assertEqual(self.timeline(), [])
+        self.assertEqual(sorted(self.queue()),
+                         ['job%s:A' % i for i in range(5)])
+        self.assertTrue(
+            self.bike.tell('job4:A')['status'].startswith('ENQ:'))
+
+    def test_dispatch_routes_from_client(self):
+        class ClientRouted(TestWorker):
+            def queue_for(self, jobid):
+                return self.name_queue('Z')
+        bike = Redbike(ClientRouted('A:Z'), prefix='biketest')
+        #B: Workers that rename queues don't get the server-side router.
+        self.assertEqual(bike.dispatch_script, None)
+        bike.set('job:A', 'AT:%s' % int(time.time()))
+        #B: Dispatch routes due jobs itself when the worker can't in Lua.
+        self.assertEqual(bike.dispatch_due(time.time()), 1)
+        self.assertEqual(self.queue(name='Z'), ['job:A'])
+
+    def test_flush(self):
+        self.bike.scan_count = 2
+        self.bike.set_many(('job%s:A' % i, 'CONTINUE') for i in range(12))
+        keys = len(self.r.keys('biketest-*'))
+        progress = []
+        #B: A dry run flush counts keys without deleting them.
+        self.assertEqual(self.bike.flush(dry_run=True), keys)
+        self.assertEqual(len(self.r.keys('biketest-*')), keys)
+        #B: Flush deletes keys in batches, reporting progress.
+        self.assertEqual(self.bike.flush(progress=progress.append), keys)
+        self.assertEqual(self.r.keys('biketest-*'), [])
+        self.assertEqual(progress[-1], keys)
+        self.assertTrue(len(progress) > 1)
+        self.assertTrue(all(b - a <= 2 for a, b
+                            in zip([0] + progress, progress)))
+
+    def test_metrics_and_stats(self):
+        self.bike.set('job:A', 'AT:%s' % int(time.time() - 5))
+        self.bike.set('fail:A', 'CONTINUE')
+        self.bike.set('later:A', 'AT:%s' % int(time.time() + 60))
+        #B: Stats sample queue lengths and the timeline backlog.
+        self.assertEqual(self.bike.stats(),
+                         {'queues': {'biketest-work-A': 1,
+                                     'biketest-work-Z': 0},
+                          'timeline': {'due': 1, 'scheduled': 2,
+                                       'held': 0}})
+        self.bike.dispatch(after=time.time())
+        self.bike.batch_size = 2
+        self.bike.work()
+        metrics = self.bike.metrics.snapshot()
+        #B: Metrics count jobs through dispatch and work.
+        self.assertEqual(metrics['counters'],
+                         {'dispatched': 1, 'consumed': 2, 'completed': 1,
+                          'died': 1})
+        #B: Metrics time dispatch lag, queue wait and work duration.
+        histograms = metrics['histograms']
+        self.assertTrue(histograms['dispatch_lag']['sum'] >= 5)
+        self.assertEqual(histograms['queue_wait']['count'], 2)
+        self.assertEqual(histograms['work_duration']['count'], 2)
+
+    def test_observers(self):
+        events = []
+
+        class Recorder(Observer):
+            def on_dispatch_batch(self, shard, count, point_in_time):
+                events.append(('dispatch', count))
+
+            def on_claim(self, claimed):
+                events.append(('claim', [jobid for jobid, _ in claimed]))
+
+            def on_work_start(self, jobid):
+                events.append(('start', jobid))
+
+            def on_work_end(self, jobid, duration, outcome):
+                events.append(('end', jobid, outcome))
+
+            def on_reschedule(self, jobid, result):
+                events.append(('reschedule', jobid, result))
+
+        self.bike.add_observer(Recorder())
+        self.bike.set('job:A', 'AT:%s' % int(time.time()))
+        self.bike.set('fail:A', 'CONTINUE')
+        self.bike.dispatch(after=time.time())
+        self.bike.batch_size = 2
+        self.bike.work()
+        #B: Observers hear about each step a job goes through.
+        self.assertEqual(events, [('dispatch', 1),
+                                  ('claim', ['fail:A', 'job:A']),
+                                  ('start', 'fail:A'),
+                                  ('end', 'fail:A', 'died'),
+                                  ('start', 'job:A'),
+                                  ('end', 'job:A', 'completed'),
+                                  ('reschedule', 'job:A', None)])
+
+    def test_failing_observers(self):
+        class Failing(Observer):
+            def on_dispatch_batch(self, shard, count, point_in_time):
+                raise Exception("Boom")
+
+            def on_work_start(self, jobid):
+                raise Exception("Boom")
+
+        self.bike.add_observer(Failing())
+        self.bike.set('job:A', 'AT:%s' % int(time.time()))
+        self.bike.set('cont:A', 'CONTINUE')
+        #B: Observers that raise don't stop dispatch.
+        self.assertEqual(self.bike.dispatch_due(time.time()), 1)
+        #B: Observers that raise don't keep jobs from being worked.
+        self.bike.batch_size = 2
+        self.bike.work()
+        self.assertEqual(self.result('job:A'), '1')
+        self.assertEqual(self.result('cont:A'), '1')
+        #B: Observers that raise don't keep jobs from being rescheduled.
+        self.assertEqual(self.queue(), ['cont:A'])
+        self.assertFalse(self.bike.is_working('cont:A'))
+
+    def test_sharded_dispatch(self):
+        bike = Redbike(TestWorker('A:Z'), prefix='biketest', shards=3)
+        jobids = ['job%s:A' % i for i in range(12)]
+        for jobid in jobids:
+            bike.set(jobid, 'AT:%s' % int(time.time()))
+        #B: Jobs are spread across timeline shards by jobid.
+        shards = [list(map(_e, self.r.zrange(bike.shard_keys(i).timeline_key,
+                                             0, -1)))
+                  for i in range(3)]
+        self.assertEqual(sorted(sum(shards, [])), sorted(jobids))
+        self.assertTrue(all(shards))
+        self.assertEqual(self.timeline(), [])
+        #B: Tell finds a job on its shard.
+        self.assertTrue(bike.tell('job0:A')['next_run'])
+        #B: Unset removes a job from its shard.
+        bike.unset('job0:A')
+        self.assertEqual(bike.tell('job0:A')['next_run'], None)
+        #B: A shard's dispatcher only moves that shard's jobs.
+        self.assertEqual(bike.dispatch_due(time.time(), shard=1),
+                         len([j for j in shards[1] if j != 'job0:A']))
+        self.assertEqual(sorted(self.queue()),
+                         sorted(j for j in shards[1] if j != 'job0:A'))
+        #B: Without a shard, dispatch drains every shard.
+        bike.dispatch()
+        self.assertEqual(sorted(self.queue()), sorted(jobids[1:]))
+
+    def test_cluster_key_layout(self):
+        class StandaloneRedbike(Redbike):
+            # The cluster key layout works on a single server too.
+            def connect(self, redis_config):
+                return self.redis_class(**redis_config)
+        StandaloneRedbike.redis_class = type(self.r)
+        bike = StandaloneRedbike(TestWorker('A:Z'), prefix='biketest',
+                                 shards=2, cluster=True)
+        bike.worker.bike = bike
+        jobids = ['job%s:A' % i for i in range(6)]
+        for jobid in jobids:
+            bike.set(jobid, 'AT:%s' % int(time.time()))
+        #B: In cluster mode each shard's keys share a hash tag.
+        self.assertEqual(bike.timeline_for('job0:A'),
+                         '{biketest-%s}-timeline' % bike.shard_of('job0:A'))
+        self.assertEqual(
+            bike.queue_for('job0:A'),
+            '{biketest-%s}-work-A' % bike.shard_of('job0:A'))
+        #B: In cluster mode workers consume every shard's queues.
+        self.assertEqual(bike.queue_names(),
+                         ['{biketest-0}-work-A', '{biketest-0}-work-Z',
+                          '{biketest-1}-work-A', '{biketest-1}-work-Z'])
+        bike.batch_size = len(jobids)
+        bike.dispatch()
+        for _ in bike.queue_names():
+            bike.work()
+        for jobid in jobids:
+            self.assertEqual(self.result(jobid), '1')
+        #B: Statuses and schedules are gathered from every shard.
+        statuses = list(bike.get_statuses())
+        self.assertEqual(sorted(jobid for jobid, _, _ in statuses), jobids)
+        self.assertEqual([ts for _, _, ts in statuses],
+                         sorted(ts for _, _, ts in statuses))
+        self.assertEqual(sorted(bike.get_schedules()),
+                         [(jobid, 'STOP') for jobid in jobids])
+        #B: Flush clears every shard's keys.
+        bike.flush()
+        self.assertEqual(self.r.keys('{biketest-*'), [])
+
+    def test_dispatch_backpressure(self):
+        self.bike.worker.high_water = (
+            lambda queue_name: 2 if queue_name.endswith('A') else None)
+        self.bike.dispatch_limit = 2
+        now = int(time.time())
+        for i in range(5):
+            self.bike.set('job%s:A' % i, 'AT:%s' % (now - 10 + i))
+        self.bike.set('job:Z', 'AT:%s' % now)
+        #B: Dispatch holds back due jobs for a full queue.
+        self.assertEqual(self.bike.drain(now), 3)
+        self.assertEqual(self.queue(), ['job1:A', 'job0:A'])
+        self.assertEqual(self.bike.tell('job2:A')['next_run'], now - 8)
+        self.assertEqual(self.bike.stats()['timeline']['held'], 3)
+        #B: Due jobs for other queues get past those held back.
+        self.assertEqual(self.queue(name='Z'), ['job:Z'])
+        #B: Held back jobs are dispatched in score order as room returns.
+        self.r.rpop('biketest-work-A')
+        self.assertEqual(self.bike.drain(now), 0)
+        self.assertEqual(self.bike.stats()['timeline']['held'], 2)
+        self.assertEqual(self.queue(), ['job2:A', 'job1:A'])
+        #B: Held back jobs don't keep the dispatcher from sleeping.
+        self.bike.max_sleep = .5
+        self.r.delete(self.bike.wakeup_key)
+        started = time.time()
+        self.bike.sleep_until_due()
+        self.assertTrue(time.time() - started >= .4)
+        #B: A configured default high-water mark applies to every queue.
+        self.bike.worker.high_water = lambda queue_name: None
+        self.bike.default_high_water = 1
+        self.bike.set('job2:Z', 'AT:%s' % now)
+        self.assertEqual(self.bike.drain(now), 1)
+        #B: Jobs set again aren't held back any more.
+        self.bike.set('job4:A', 'AT:%s' % (now + 60))
+        self.bike.unset('job3:A')
+        self.assertEqual(self.bike.tell('job4:A')['next_run'], now + 60)
+        self.assertEqual(self.bike.stats()['timeline']['held'], 1)
+
+    def test_dispatch_backpressure_backlog(self):
+        self.bike.worker.high_water = (
+            lambda queue_name: 5 if queue_name.endswith('A') else None)
+        self.bike.dispatch_limit = 10
+        now = time.time()
+        self.bike.set_many([('job%s:A' % i, 'AT:%s' % (now - 100 + i * .01))
+                            for i in range(2000)])
+        #B: Jobs held back for a full queue are only read once.
+        self.assertEqual(self.bike.drain(now), 1995)
+        self.assertEqual(self.r.zcard(self.bike.timeline_key), 0)
+        self.bike.set('job:Z', 'AT:%s' % now)
+        self.assertEqual(self.bike.dispatch_page(now), (1, 0))
+        self.assertEqual(self.bike.stats()['timeline']['held'], 1995)
+        self.assertEqual(self.queue(name='Z'), ['job:Z'])
+        #B: A backlog held back goes out oldest first as room returns.
+        self.r.delete('biketest-work-A', 'biketest-work-A-members')
+        self.assertEqual(self.bike.drain(now), 0)
+        self.assertEqual(self.queue()[::-1],
+                         ['job%s:A' % i for i in range(5, 10)])
+
+    def test_rate_limit(self):
+        self.bike.worker.rate_limit = (
+            lambda queue_name: 5 if queue_name.endswith('A') else None)
+        self.bike.batch_size = 10
+        self.bike.block_timeout = 0
+        for i in range(20):
+            self.bike.set('job%s:A' % i, 'NOW')
+        consumer = self.bike.consumer_generator()
+        #B: A rate limited queue gives up a burst of its rate at most.
+        self.assertEqual(len(next(consumer)), 5)
+        next(consumer)  # queue Z
+        #B: A rate limited queue gives up no more until its bucket refills.
+        self.assertEqual(len(next(consumer)), 0)
+        next(consumer)
+        time.sleep(.45)
+        self.assertEqual(len(next(consumer)), 2)
+        next(consumer)
+        #B: A worker's clock running ahead doesn't refill the bucket.
+        ahead = time.time() + 3600
+        flexmock(time).should_receive('time').replace_with(lambda: ahead)
+        self.assertEqual(len(next(consumer)), 0)
+        #B: Workers don't block on rate limited queues.
+        self.assertEqual(list(self.bike.blocking_shards()),
+                         ['biketest-work-Z'])
+
+    def test_spread(self):
+        rrule = "DTSTART:20200101T000000\nRRULE:FREQ=MINUTELY"
+        after = calendar.timegm((2020, 1, 1, 0, 10, 0))
+        plain = self.bike.next_runs(rrule, after=after, jobid='job:A')
+        self.bike.worker.spread = (
+            lambda jobid: 30 if jobid.endswith('A') else None)
+        spread = self.bike.next_runs(rrule, after=after, jobid='job:A')
+        #B: Jobs without a spread run on the RRULE's times.
+        self.assertEqual(
+            self.bike.next_runs(rrule, after=after, jobid='job:Z'), plain)
+        #B: Hash spread offsets all of a job's runs by the same amount.
+        self.assertEqual(set(run % 60 for run in spread),
+                         set([spread[0] % 60]))
+        self.assertTrue(0 < spread[0] % 60 < 30)
+        self.assertEqual(set(b - a for a, b in zip(spread, spread[1:])),
+                         set([60]))
+        self.assertTrue(after < spread[0] < plain[0])
+        #B: Hash spread is the same every time for a job.
+        self.assertEqual(
+            self.bike.next_runs(rrule, after=after, jobid='job:A'), spread)
+        #B: Different jobs are spread differently.
+        self.assertTrue(len(set(
+            self.bike.next_runs(rrule, after=after, jobid='job%s:A' % i)[0]
+            for i in range(10))) > 1)
+        #B: Random spread keeps each run within its window, in order.
+        self.bike.spread_mode = 'random'
+        runs = self.bike.next_runs(rrule, after=after, jobid='job:A')
+        self.assertEqual(runs, sorted(runs))
+        self.assertEqual(len(runs), self.bike.lookahead)
+        self.assertTrue(runs[0] > after)
+        for run in runs:
+            self.assertTrue(0 <= run % 60 < 30)
+        #B: Spread runs go on the timeline when a job is set.
+        self.bike.spread_mode = 'hash'
+        self.bike.set('job:A', rrule, after=after)
+        self.assertEqual(self.bike.tell('job:A')['next_run'], spread[0])
+        self.assertEqual(self.bike.tell('job:A')['upcoming'], spread[1:])
+
+    def test_prefetch(self):
+        self.bike.prefetch = 5
+        self.bike.max_sleep = .5
+        due = round(time.time() + .3, 3)
+        self.bike.set('job:A', 'AT:%.3f' % due)
+        self.bike.set('later:A', 'AT:%s' % int(time.time() + 60))
+        self.r.delete(self.bike.wakeup_key)
+        self.bike.release_prefetched(time.time())
+        #B: Prefetched jobs are released into their queue when due.
+        status, timestamp = self.r.hget(self.bike.statuses_key,
+                                        'job:A').decode().split(':')
+        self.assertEqual(status, 'ENQ')
+        self.assertTrue(abs(float(timestamp) - due) < .05)
+        #B: Jobs beyond the prefetch window stay on the timeline.
+        self.assertEqual(self.r.zcard(self.bike.timeline_key), 1)
+        #B: Jobs set inside the window read ahead wake the dispatcher.
+        self.r.delete(self.bike.wakeup_key)
+        self.bike.set('soon:A', 'AT:%s' % int(time.time() + 2))
+        self.assertEqual(self.r.llen(self.bike.wakeup_key), 1)
+        #B: Jobs moved since they were read aren't released.
+        score = self.r.zscore(self.bike.timeline_key, 'soon:A')
+        self.bike.set('soon:A', 'AT:%s' % int(time.time() + 3))
+        self.assertEqual(self.bike.release([('soon:A', score)]), 0)
+        score = self.r.zscore(self.bike.timeline_key, 'soon:A')
+        self.assertEqual(self.bike.release([('soon:A', score)]), 1)
+        #B: Jobs removed since they were read aren't released.
+        self.bike.unset('later:A')
+        self.assertEqual(self.bike.release([('later:A', score)]), 0)
+        self.assertEqual(self.queue(), ['soon:A', 'job:A'])
+
+    def test_subsecond_precision(self):
+        due = round(time.time() + .3, 3)
+        self.bike.set('job:A', 'AT:%.3f' % due)
+        #B: AT: schedules keep their milliseconds on the timeline.
+        self.assertEqual(self.bike.tell('job:A')['next_run'], due)
+        #B: Jobs due within the second aren't dispatched early.
+        self.assertEqual(self.bike.dispatch_due(time.time()), 0)
+        #B: The dispatcher wakes at the moment a job is due.
+        self.r.delete(self.bike.wakeup_key)
+        self.bike.sleep_until_due()
+        self.assertTrue(abs(time.time() - due) < .1)
+        self.assertEqual(self.bike.dispatch_due(time.time()), 1)
+        #B: Backoffs can be fractions of a second.
+        started = time.time()
+        self.bike.schedule('job:Z', 'CONTINUE', backoff=.25)
+        next_run = self.bike.tell('job:Z')['next_run']
+        self.assertTrue(started + .249 <= next_run < started + .3)
+        #B: Whole second timestamps written before are still read.
+        self.r.hset(self.bike.statuses_key, 'old:A', 'ENQ:1000')
+        self.bike.reindex_statuses()
+        self.assertEqual(next(self.bike.get_statuses()),
+                         ('old:A', 'ENQ', 1000))
+
+    def test_dispatcher_sleeps_until_due(self):
+        self.bike.max_sleep = 5
+        self.bike.set('later:A', 'AT:%s' % int(time.time() + 60))
+        self.bike.set('sooner:A', 'AT:%s' % int(time.time() + 1))
+        self.bike.set('latest:A', 'AT:%s' % int(time.time() + 120))
+        #B: Only jobs that become the earliest on the timeline wake dispatch.
+        self.assertEqual(self.r.llen(self.bike.wakeup_key), 1)
+        self.r.delete(self.bike.wakeup_key)
+        #B: The dispatcher sleeps until the earliest job is due.
+        started = time.time()
+        self.bike.sleep_until_due()
+        self.assertTrue(time.time() - started <= 1.1)
+        #B: Adding an earlier job wakes a sleeping dispatcher.
+        self.bike.unset('sooner:A')
+        timer = threading.Timer(
+            .2, self.bike.set, ['now:A', 'AT:%s' % int(time.time())])
+        timer.start()
+        started = time.time()
+        self.bike.sleep_until_due()
+        timer.join()
+        self.assertTrue(time.time() - started < 1)
+
+    def test_wakeup_before_redis_6(self):
+        timeouts = []
+        brpop = self.r.brpop
+        self.r.brpop = lambda keys, timeout: (timeouts.append(timeout) or
+                                              brpop(keys, timeout))
+        #B: Servers from Redis 6 on are given fractional timeouts.
+        self.assertTrue(self.bike.fractional_timeouts())
+        self.bike.wait_for_wakeup([self.bike.wakeup_key], .2)
+        self.assertEqual(timeouts, ['0.200'])
+        #B: Older servers are given whole seconds, the rest slept after.
+        flexmock(self.bike).should_receive(
+            'fractional_timeouts').and_return(False)
+        started = time.time()
+        self.bike.wait_for_wakeup([self.bike.wakeup_key], 1.5)
+        self.bike.wait_for_wakeup([self.bike.wakeup_key], .2)
+        self.assertEqual(timeouts, ['0.200', 1])
+        self.assertTrue(1.1 < time.time() - started < 1.5)
+
+    def test_set_many(self):
+        rows = [('job%s:A' % i, 'CONTINUE') for i in range(5)]
+        rows.insert(4, ('badat:A', 'AT:soon'))
+        rows += [('rrule:A', self.gen_rrule()),
+                 ('bad:A', 'RRULE:FREQ=SOMETIMES'),
+                 ('short:A',)]
+        progress = []
+        #B: Setting many jobs reports rows and bad rows as chunks are set.
+        counts = self.bike.set_many(
+            rows, chunk_size=3, progress=lambda *p: progress.append(p))
+        self.assertEqual(counts, (9, 3))
+        self.assertEqual(progress, [(3, 0), (6, 1), (9, 3)])
+        #B: Setting many jobs schedules them just like setting each one.
+        self.assertEqual(len(self.queue()), 5)
+        self.assertEqual(self.timeline(), ['rrule:A'])
+        self.assertTrue(self.bike.tell('bad:A')['status'].startswith('BAD:'))
+        self.assertEqual(self.bike.tell('short:A')['schedule'], None)
+        #B: A bad AT: time is marked bad without holding up its chunk.
+        self.assertTrue(
+            self.bike.tell('badat:A')['status'].startswith('BAD:'))
+        self.assertEqual(self.bike.tell('job4:A')['schedule'], 'CONTINUE')
+
+    def test_statuses_and_schedules_stream(self):
+        self.bike.scan_count = 10
+        self.bike.set_many(('job%s:A' % i, 'STOP') for i in range(100))
+        self.bike.set_status('job0:A', 'WRK', timestamp=time.time() + 60)
+        flexmock(self.r).should_receive('hgetall').times(0)
+        #B: Statuses are streamed from Redis a page at a time.
+        statuses = list(self.bike.get_statuses())
+        self.assertEqual(len(statuses), 99)
+        self.assertEqual(statuses[0][1], 'STP')
+        self.assertTrue('job0:A' not in set(s[0] for s in statuses))
+        #B: Schedules are streamed from Redis a page at a time.
+        self.assertEqual(dict(self.bike.get_schedules()),
+                         dict(('job%s:A' % i, 'STOP') for i in range(100)))
+
+    def test_status_index(self):
+        self.bike.scan_count = 2
+        for i in range(5):
+            self.bike.set_status('job%s:A' % i, 'ENQ', timestamp=100 + i)
+        self.bike.set_status('job4:A', 'WRK', timestamp=200)
+        self.bike.set('job5:A', 'STOP')
+        #B: Statuses come back oldest first from the status index.
+        self.assertEqual(list(self.bike.get_statuses(before=150)),
+                         [('job%s:A' % i, 'ENQ', 100 + i) for i in range(4)])
+        #B: Statuses can be narrowed down to those for one event.
+        self.assertEqual(list(self.bike.get_statuses(event='WRK')),
+                         [('job4:A', 'WRK', 200)])
+        self.assertEqual(
+            [jobid for jobid, _, _ in self.bike.get_statuses(event='ENQ')],
+            ['job%s:A' % i for i in range(4)])
+        #B: Unsetting a job drops it from the status index.
+        self.bike.unset('job4:A')
+        self.assertEqual(list(self.bike.get_statuses(event='WRK')), [])
+        self.assertEqual(self.r.zcard(self.bike.status_index_key), 5)
+        #B: Statuses set without the index can be indexed after the fact.
+        self.r.delete(self.bike.status_index_key,
+                      self.bike.status_index_key + '-ENQ')
+        self.assertEqual(self.bike.reindex_statuses(), 5)
+        self.assertEqual(len(list(self.bike.get_statuses(event='ENQ'))), 4)
+
     def test_dispatch_with_after(self):
         #B: Dispatching with an after overrides the timefile.
         flexmock(self.bike).should_receive('point_in_time').never
         self.bike.dispatch(after=8)
 
+    def test_redis_checkpoint(self):
+        bike = Redbike(TestWorker('A:Z'), prefix='biketest',
+                       checkpoint='redis')
+        bike.dispatch(after=123.5)
+        #B: The dispatcher can keep its checkpoint in Redis.
+        self.assertEqual(_e(self.r.get(bike.checkpoint_key)), '123.500')
+        #B: Dispatchers on any host resume from the Redis checkpoint.
+        other = Redbike(TestWorker('A:Z'), prefix='biketest',
+                        checkpoint='redis', timefile='/nonexistent')
+        self.assertEqual(other.point_in_time(), 123.5)
+
     def test_clear_control_dont_halt(self):
         #B: The check for halted returns false when control is cleared.
         self.bike.clear_control()
         self.assertFalse(self.bike.is_halted())
 
+    def test_control_listener(self):
+        self.bike.clear_control()
+        bike = Redbike(TestWorker('A:Z'), prefix='biketest')
+        bike.listen_for_control()
+        #B: A listening process doesn't check the control key for HALT.
+        self.r.set(self.bike.control_key, 'HALT')
+        self.assertFalse(bike.is_halted())
+        #B: A listening process hears HALT and sets its stop event.
+        self.bike.control('HALT')
+        self.assertTrue(bike.stop_event.wait(2))
+        self.assertTrue(bike.is_halted())
+        #B: Clearing control undoes a stop made by HALT.
+        self.bike.clear_control()
+        for _ in range(20):
+            if not bike.is_halted():
+                break
+            time.sleep(.1)
+        self.assertFalse(bike.is_halted())
+
+    def test_next_runs_in_local_time_zone(self):
+        rrule = "DTSTART:20200101T000000\nRRULE:FREQ=HOURLY"
+        after = calendar.timegm((2020, 1, 1, 5, 30, 0))
+        tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'EST+5'
+        time.tzset()
+        try:
+            runs = self.bike.next_runs(rrule, after=after)
+        finally:
+            if tz is None:
+                del os.environ['TZ']
+            else:
+                os.environ['TZ'] = tz
+            time.tzset()
+        #B: Runs after a point in time don't depend on the local time zone.
+        self.assertEqual(runs[0], calendar.timegm((2020, 1, 1, 6, 0, 0)))
+
+    def test_control_listener_errors(self):
+        self.bike.clear_control()
+        bike = Redbike(TestWorker('A:Z'), prefix='biketest')
+        pubsub = bike.redis.pubsub
+        failures = [redis.ResponseError("not now")]
+
+        def flaky_pubsub(**kwargs):
+            if failures:
+                raise failures.pop()
+            return pubsub(**kwargs)
+        bike.redis.pubsub = flaky_pubsub
+        #B: The listener resubscribes after errors other than lost ones.
+        bike.listen_for_control()
+        self.assertFalse(failures)
+        self.bike.control('HALT')
+        self.assertTrue(bike.stop_event.wait(5))
+        self.bike.clear_control()
+        #B: Processes check the control key if their listener died.
+        bike = Redbike(TestWorker('A:Z'), prefix='biketest')
+        bike._control_thread = threading.Thread(target=lambda: None)
+        bike._control_thread.start()
+        bike._control_thread.join()
+        self.assertFalse(bike.is_halted())
+        self.r.set(self.bike.control_key, 'HALT')
+        self.assertTrue(bike.is_halted())
+
+    def test_pause_and_resume(self):
+        self.bike.block_timeout = 0
+        self.bike.set('job:A', 'NOW')
+        self.bike.set('job:Z', 'NOW')
+        #B: Pausing a queue needs its name.
+        self.assertRaises(ValueError, self.bike.control, 'PAUSE')
+        #B: Workers don't claim jobs from paused queues.
+        self.bike.control('PAUSE', 'work-A')
+        self.assertTrue(self.bike.is_halted())
+        self.assertEqual(self.claim()[0], 'job:Z')
+        self.assertEqual(list(self.bike.blocking_shards()),
+                         ['biketest-work-Z'])
+        #B: Resumed queues are worked again.
+        self.bike.control('RESUME', 'work-A')
+        self.bike.is_halted()
+        self.assertEqual(self.claim()[0], 'job:A')
+
     def test_point_in_time_defaults_to_now(self):
         #B: Missing timefile means we fall back to now.
         os.rename(self.bike.timefile, 'tests/timefile.tmp')
@@ -255,6 +856,74 @@ class RedbikeTests(TestCase):
         self.assertEqual(self.bike.point_in_time(), 9)
         os.rename('tests/timefile.tmp', self.bike.timefile)
 
+    def test_failed_refill(self):
+        self.bike.lookahead = 1
+        self.bike.set('rrule:A', "RRULE:FREQ=SECONDLY")
+        self.bike.set('job:A', 'CONTINUE')
+        self.bike.dispatch_due(time.time() + 5)
+        self.bike.batch_size = 2
+        claimed = next(self.bike.consumer)
+        self.assertEqual(len(claimed), 2)
+        flexmock(self.bike).should_receive('schedule').and_raise(
+            Exception("Boom"))
+        self.bike.work_batch(claimed)
+        #B: Jobs whose next runs can't be scheduled are marked dead.
+        self.assertTrue(self.bike.tell('rrule:A')['status'].startswith('DIE'))
+        #B: Jobs already rescheduled are left alone when that fails.
+        self.assertTrue(self.bike.tell('job:A')['status'].startswith('ENQ'))
+        self.assertEqual(self.queue(), ['job:A'])
+
+    def test_reschedule_unpiped(self):
+        self.bike.lookahead = 1
+        self.bike.set('rrule:A', "RRULE:FREQ=SECONDLY")
+        self.bike.dispatch_due(time.time() + 5)
+        jobid, jobtag = self.claim()
+        #B: Rescheduling outside a pipeline schedules an RRULE's next runs.
+        self.assertEqual(_e(self.bike.reschedule(jobid, jobtag)),
+                         "RRULE:FREQ=SECONDLY")
+        self.assertTrue(self.bike.tell(jobid)['next_run'] > time.time())
+        self.assertTrue(self.bike.tell(jobid)['status'].startswith('TML'))
+
+    def test_worker_thread_restarts(self):
+        consume = self.bike.consume
+        failures = []
+
+        def consume_once_failing(shard, queue_name):
+            if not failures:
+                failures.append(queue_name)
+                raise Exception("Boom")
+            return consume(shard, queue_name)
+        self.bike.consume = consume_once_failing
+        self.bike.set('job:A', 'CONTINUE')
+        #B: A worker thread that dies is started over.
+        self.bike.work_threads(1)
+        self.assertEqual(failures, ['biketest-work-A'])
+        self.assertEqual(self.result('job:A'), '1')
+
+    def test_minimal_worker(self):
+        bike = Redbike(MinimalWorker(), prefix='biketest',
+                       default_high_water=5)
+        bike.set('job:A', 'AT:%s' % int(time.time()))
+        #B: Workers without a high_water() get the default high-water mark.
+        self.assertEqual(bike.high_water('biketest-work-A'), 5)
+        self.assertEqual(bike.drain(time.time()), 0)
+        self.assertEqual(self.queue(), ['job:A'])
+        #B: Workers without a rate_limit() aren't rate limited.
+        self.assertEqual(bike.rate_limit('biketest-work-A'), None)
+        claimed = next(bike.consumer_generator())
+        self.assertEqual([_e(jobid) for jobid, _ in claimed], ['job:A'])
+        self.assertTrue(bike.is_working('job:A'))
+        #B: Workers without a spread() get the default spread.
+        bike.default_spread = 10
+        self.assertEqual(bike.spread('job:A'), 10)
+        rrule = "RRULE:FREQ=MINUTELY"
+        runs = bike.next_runs(rrule, after=1000000000, jobid='job:A')
+        unspread = bike.next_runs(rrule, after=1000000000)
+        offsets = set(run - unspread_run
+                      for run, unspread_run in zip(runs, unspread))
+        self.assertEqual(len(offsets), 1)
+        self.assertTrue(0 <= offsets.pop() < 10)
+
     def test_stop_work(self):
         self.bike.set('stopper:A', 'CONTINUE')
         #B: Raising StopWork cause the job to be scheduled STOP.
@@ -326,6 +995,135 @@ class RedbikeTests(TestCase):
         self.assertTrue(self.bike.is_working('job:A'))
         self.assertEqual(self.queue(), [])
 
+    def test_blocking_consume(self):
+        #B: Workers wait for work after a pass finds every queue empty.
+        self.assertEqual([next(self.bike.consumer) for _ in range(2)],
+                         [[], []])
+        timer = threading.Timer(.2, self.bike.set, ['job:Z', 'CONTINUE'])
+        timer.start()
+        started = time.time()
+        [(jobid, jobtag)] = next(self.bike.consumer)
+        timer.join()
+        self.assertTrue(time.time() - started < 1)
+        #B: A job picked up while waiting is claimed like any other.
+        self.assertEqual(jobid, 'job:Z')
+        self.assertEqual(self.queue(name='Z'), [])
+        self.assertTrue(self.bike.is_working('job:Z'))
+        self.assertTrue(self.bike.tell('job:Z')['status'].startswith('WRK:'))
+        self.assertEqual(_e(self.r.get(self.bike.is_working_key('job:Z'))),
+                         jobtag)
+        self.assertTrue(self.r.ttl(self.bike.is_working_key('job:Z')) <= 1)
+        #B: Waiting for work gives up after block_timeout.
+        self.assertEqual([next(self.bike.consumer) for _ in range(3)],
+                         [[], [], []])
+        #B: A worker lost after waking leaves the job on its queue.
+        self.bike.set('job:A', 'CONTINUE')
+        self.r.brpop(self.bike.ready_key('biketest-work-A'), 1)
+        self.assertEqual(self.queue(), ['job:A'])
+        self.assertEqual(self.claim()[0], 'job:A')
+        #B: Claiming clears wakeup tokens left by jobs taken off queues.
+        ready_key = self.bike.ready_key('biketest-work-A')
+        self.bike.set('gone:A', 'CONTINUE')
+        self.bike.unset('gone:A')
+        self.assertEqual(self.r.llen(ready_key), 1)
+        self.bike.consume(0, 'biketest-work-A')
+        self.assertEqual(self.r.llen(ready_key), 0)
+
+    def test_batch_consume(self):
+        self.bike.batch_size = 4
+        jobids = ['job:A', 'stopper:A', 'fail:A', 'unset:A', 'backoff:2:A']
+        for jobid in jobids:
+            self.bike.set(jobid, 'CONTINUE')
+        #B: Workers claim up to batch_size jobs from a queue at a time.
+        claimed = next(self.bike.consumer)
+        self.assertEqual([jobid for jobid, _ in claimed], jobids[:4])
+        self.assertEqual(len(set(jobtag for _, jobtag in claimed)), 4)
+        for jobid in jobids[:4]:
+            self.assertTrue(self.bike.is_working(jobid))
+            self.assertTrue(
+                self.bike.tell(jobid)['status'].startswith('WRK:'))
+        self.assertEqual(self.queue(), ['backoff:2:A'])
+        #B: Each job in a batch is wrapped up as if worked on its own.
+        self.bike.work_batch(claimed)
+        for jobid in jobids[:4]:
+            self.assertEqual(self.result(jobid), '1')
+            self.assertFalse(self.bike.is_working(jobid))
+        self.assertEqual(self.queue(), ['job:A', 'backoff:2:A'])
+        self.assertEqual(self.bike.tell('stopper:A')['schedule'], 'STOP')
+        self.assertTrue(
+            self.bike.tell('stopper:A')['status'].startswith('STP:'))
+        self.assertTrue(self.bike.tell('fail:A')['status'].startswith('DIE:'))
+        self.assertEqual(self.bike.tell('unset:A')['schedule'], None)
+        self.work_round()
+        self.assertEqual(self.timeline(), ['backoff:2:A'])
+        self.assertEqual(self.queue(), ['job:A'])
+
+    def test_timed_out_job_not_rescheduled_in_batch(self):
+        self.bike.batch_size = 2
+        self.bike.set('job:A', 'CONTINUE')
+        self.bike.set('job2:A', 'CONTINUE')
+        claimed = next(self.bike.consumer)
+        self.r.delete(self.bike.is_working_key('job2:A'))
+        #B: Jobs in a batch that time out are not rescheduled.
+        self.bike.work_batch(claimed)
+        self.assertEqual(self.queue(), ['job:A'])
+
+    def test_reschedule(self):
+        self.bike.set('job:A', 'CONTINUE')
+        jobid, jobtag = self.claim()
+        #B: Rescheduling a job held under another jobtag does nothing.
+        self.assertEqual(self.bike.reschedule(jobid, 'nottag'), None)
+        self.assertTrue(self.bike.is_working(jobid))
+        self.assertEqual(self.queue(), [])
+        #B: Rescheduling releases the job and requeues it in one step.
+        self.assertEqual(self.bike.reschedule(jobid, jobtag), None)
+        self.assertFalse(self.bike.is_working(jobid))
+        self.assertEqual(self.queue(), ['job:A'])
+        #B: Rescheduling an AT:TIMESTAMP job puts it on the timeline.
+        self.bike.set_schedule('job:A', 'AT:%s' % int(time.time() + 60))
+        jobid, jobtag = self.claim()
+        self.assertEqual(self.bike.reschedule(jobid, jobtag), None)
+        self.assertEqual(self.timeline(), ['job:A'])
+        self.assertEqual(self.bike.tell('job:A')['schedule'], 'STOP')
+        #B: Rescheduling an RRULE job leaves the next run to the client.
+        rrule = self.gen_rrule()
+        self.bike.set('job:A', 'NOW')
+        self.bike.set_schedule('job:A', rrule)
+        jobid, jobtag = self.claim()
+        self.assertEqual(_e(self.bike.reschedule(jobid, jobtag)), rrule)
+        self.assertFalse(self.bike.is_working(jobid))
+
+    def test_work_threads(self):
+        for i in range(3):
+            self.bike.set('job%s:A' % i, 'NOW')
+        #B: Workers can work several jobs at once in threads.
+        self.bike.work(concurrency=3, executor='thread')
+        for i in range(3):
+            self.assertEqual(self.result('job%s:A' % i), '1')
+            self.assertTrue(
+                self.bike.tell('job%s:A' % i)['status'].startswith('STP:'))
+
+    def test_work_processes(self):
+        for i in range(3):
+            self.bike.set('job%s:A' % i, 'NOW')
+        #B: Workers can work several jobs at once in forked processes.
+        self.bike.work(concurrency=3, executor='process')
+        for i in range(3):
+            self.assertEqual(self.result('job%s:A' % i), '1')
+            self.assertTrue(
+                self.bike.tell('job%s:A' % i)['status'].startswith('STP:'))
+
+    def test_work_processes_stop_event(self):
+        self.bike.clear_control()
+        self.bike.stop_event = threading.Event()
+        self.bike.set('job:A', 'CONTINUE')
+        threading.Timer(1, self.bike.stop_event.set).start()
+        #B: Setting the stop event stops forked workers after their job.
+        self.bike.work(concurrency=2, executor='process')
+        self.assertFalse(self.bike.is_working('job:A'))
+        self.assertEqual(self.queue(), ['job:A'])
+        self.assertTrue(int(self.result('job:A')) > 1)
+
     def test_timeouts(self):
         #B: Job is not rescheduled if it times out.
         self.bike.set('job:Z', 'CONTINUE')
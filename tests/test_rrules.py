@@ -0,0 +1,51 @@
+from datetime import datetime
+import time
+from unittest import TestCase
+
+from redbike.rrules import RRuleCache
+
+
+RRULE = "DTSTART:20131009T164510\nRRULE:FREQ=MINUTELY"
+BAD_RRULE = "DTSTART:20131009T164510\nR:FREQ=Secondly"
+
+
+class RRuleCacheTests(TestCase):
+
+    def setUp(self):
+        self.cache = RRuleCache(maxsize=2)
+
+    def test_parsed_once(self):
+        rrule = self.cache.get(RRULE)
+        #B: A schedule string is parsed once and then served from cache.
+        self.assertTrue(self.cache.get(RRULE) is rrule)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_rrule_without_dtstart(self):
+        schedule = "RRULE:FREQ=SECONDLY;COUNT=2"
+        first = self.cache.get(schedule)
+        time.sleep(1.1)
+        #B: Rules without a DTSTART start from when they're asked for.
+        rrule = self.cache.get(schedule)
+        self.assertTrue(rrule is not first)
+        self.assertEqual(len(list(rrule.xafter(datetime.now()))), 1)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_bad_rrule_cached(self):
+        #B: Bad schedules raise ValueError, from the cache the second time.
+        self.assertRaises(ValueError, self.cache.get, BAD_RRULE)
+        self.assertRaises(ValueError, self.cache.get, BAD_RRULE)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_lru_eviction(self):
+        self.cache.get(RRULE)
+        self.cache.get(RRULE + ";COUNT=2")
+        self.cache.get(RRULE)
+        self.cache.get(RRULE + ";COUNT=3")
+        #B: The least recently used rrule is evicted when the cache is full.
+        self.assertEqual(self.cache.stats(),
+                         {"hits": 1, "misses": 3, "evictions": 1,
+                          "size": 2, "maxsize": 2})
+        self.cache.get(RRULE)
+        self.assertEqual(self.cache.hits, 2)
+        self.cache.get(RRULE + ";COUNT=2")
+        self.assertEqual(self.cache.misses, 4)